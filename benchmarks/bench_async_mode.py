@@ -0,0 +1,98 @@
+"""Сравнение пропускной способности обычного и асинхронного режима Bot API.
+
+Поднимает локальный фейковый Bot API с искусственной задержкой ответа и гоняет
+через него одинаковые сценарии: в обычном режиме — на пуле из двух потоков, как
+у TeleBot по умолчанию, в асинхронном — через AsyncBotAdapter.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot
+from telebot import apihelper
+
+import rate_calculator_plugin as plugin
+
+# Курсы для главного меню читаются без общего файла курсов других экземпляров
+plugin.shared_rates = None
+
+API_LATENCY = 0.05
+CHATS = 50
+TELEBOT_THREADS = 2
+RESPONSE = json.dumps({
+    "ok": True,
+    "result": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "ok"},
+}).encode()
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    def _reply(self):
+        time.sleep(API_LATENCY)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def flow(bot, chat_id: int):
+    # Типичный ответ обработчика: правка меню, результат и новое меню
+    bot.edit_message_text("⚙️ Выберите обновляемый курс:", chat_id, 1)
+    bot.send_message(chat_id, "✅ Курс успешно обновлён!")
+    bot.send_message(chat_id, plugin.generate_main_message(), parse_mode="HTML")
+
+
+def run_threaded(bot) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=TELEBOT_THREADS) as pool:
+        for chat_id in range(CHATS):
+            pool.submit(flow, bot, chat_id)
+    return time.perf_counter() - start
+
+
+def run_async(bot) -> float:
+    adapter = plugin.AsyncBotAdapter(bot)
+    futures = []
+    original_submit = adapter.submit
+
+    def submit(name, *args, **kwargs):
+        future = original_submit(name, *args, **kwargs)
+        futures.append(future)
+        return future
+
+    adapter.submit = submit
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=TELEBOT_THREADS) as pool:
+        for chat_id in range(CHATS):
+            pool.submit(flow, adapter, chat_id)
+    wait(futures)
+    return time.perf_counter() - start
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    apihelper.API_URL = f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}"
+    bot = telebot.TeleBot("123456:TEST", threaded=False)
+    calls = CHATS * 3
+    try:
+        for label, runner in (("обычный", run_threaded), ("async", run_async)):
+            elapsed = runner(bot)
+            print(f"{label:>8}: {calls} вызовов за {elapsed:6.2f} с, {calls / elapsed:7.1f} вызовов/с")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
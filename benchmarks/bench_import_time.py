@@ -0,0 +1,79 @@
+"""Время импорта плагина по python -X importtime.
+
+Cardinal импортирует каждый плагин при запуске, поэтому импорт должен быть
+дешёвым: без telebot, asyncio, urllib и sqlite3 и без чтения файлов. Скрипт
+несколько раз импортирует плагин в чистом интерпретаторе (во временной папке),
+берёт лучший результат и печатает самые тяжёлые импорты.
+
+    python benchmarks/bench_import_time.py [--repeat 5] [--budget-ms 30]
+
+Код выхода 1 — если превышен бюджет, подтянулся ленивый модуль или при
+импорте появился файл курсов. Те же проверки без замера времени выполняет
+tests/test_import.py.
+"""
+import argparse
+import os
+import py_compile
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES = ("telebot", "asyncio", "urllib.request", "concurrent.futures", "sqlite3")
+CHECK = (
+    "import sys, rate_calculator_plugin; "
+    f"print(','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))"
+)
+
+
+def import_once(workdir: str):
+    """Возвращает (время импорта плагина в мкс, {модуль: собственное время}, подтянутые ленивые модули)."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHECK],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True,
+    )
+    total, modules = 0, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_time)
+        if name.strip() == "rate_calculator_plugin":
+            total = int(cumulative)
+    return total, modules, [name for name in result.stdout.strip().split(",") if name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=None, help="бюджет на импорт плагина, мс")
+    args = parser.parse_args()
+
+    # Байткод компилируется заранее, как после первого запуска Cardinal,
+    # иначе при PYTHONDONTWRITEBYTECODE замерялась бы компиляция исходника
+    py_compile.compile(os.path.join(ROOT, "rate_calculator_plugin.py"), doraise=True)
+    with tempfile.TemporaryDirectory(prefix="rate-calculator-import-") as workdir:
+        runs = [import_once(workdir) for _ in range(args.repeat)]
+        created = sorted(os.listdir(workdir))
+    total, modules, loaded = min(runs, key=lambda run: run[0])
+
+    print(f"Импорт плагина: {total / 1000:.2f} мс (лучший из {args.repeat})")
+    print(f"  собственное время модуля: {modules.get('rate_calculator_plugin', 0) / 1000:.2f} мс")
+    for name, self_time in sorted(modules.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {self_time / 1000:8.2f} мс  {name}")
+    failed = False
+    if loaded:
+        print(f"Импортированы модули, которые должны грузиться лениво: {', '.join(loaded)}")
+        failed = True
+    if created:
+        print(f"При импорте созданы файлы: {', '.join(created)}")
+        failed = True
+    if args.budget_ms is not None and total / 1000 > args.budget_ms:
+        print(f"Бюджет {args.budget_ms} мс превышен")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Микробенчмарк статических клавиатур: сборка на каждое нажатие против кэша KeyboardRegistry."""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+ITERATIONS = 10_000
+MENUS = ("main", "update_rates", "game_selection", "back_to_game_selection")
+
+
+def rebuild(name: str) -> str:
+    # Так клавиатура собиралась до кэша: новые объекты и to_json() внутри telebot
+    return plugin.keyboards.build(name).to_json()
+
+
+def cached(name: str) -> str:
+    return plugin.keyboards.get(name)
+
+
+def measure(func):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        for name in MENUS:
+            func(name)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    for name in MENUS:
+        func(name)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = ITERATIONS * len(MENUS)
+    return elapsed / calls * 1e6, peak / len(MENUS)
+
+
+def main():
+    # Клавиатуру выбора игры регистрирует загрузка реестра игр, как в обработчиках
+    plugin.game_registry.refresh()
+    for label, func in (("сборка", rebuild), ("кэш", cached)):
+        per_call, per_call_bytes = measure(func)
+        print(f"{label:>7}: {per_call:8.2f} мкс/клавиатура, ~{per_call_bytes:8.0f} байт выделено на нажатие")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Всплеск исходящих сообщений с планировщиком OutboundScheduler и без него.
+
+FloodBot — бот в памяти с задержкой ответа и лимитами Telegram (ведро токенов
+на чат и общее): при превышении он, как Bot API, отвечает ошибкой 429 с
+retry_after. Половина чатов обновляет курс (подтверждение и главное меню),
+другая получает расчёт выгоды; вызовы идут из двух потоков, как у TeleBot по
+умолчанию.
+
+    python benchmarks/bench_outbound.py [--chats 80]
+
+Выводит число вызовов API и ошибок 429, склеенные сообщения и время ожидания
+в очереди по приоритетам.
+"""
+import argparse
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Плагин создаёт файлы курсов в текущей папке: бенчмарк работает во временной
+os.chdir(tempfile.mkdtemp(prefix="rate-calculator-bench-"))
+
+import rate_calculator_plugin as plugin
+
+# Курсы для главного меню читаются без общего файла курсов других экземпляров
+plugin.shared_rates = None
+
+API_LATENCY = 0.02
+TELEBOT_THREADS = 2
+
+
+class TooManyRequests(Exception):
+    """Ошибка 429 в том же виде, что telebot.apihelper.ApiTelegramException."""
+
+    error_code = 429
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too Many Requests: retry after {retry_after}")
+        self.result_json = {"ok": False, "error_code": 429, "parameters": {"retry_after": retry_after}}
+
+
+class FloodBot:
+    def __init__(self):
+        now = time.monotonic()
+        self._lock = threading.Lock()
+        self._global = plugin.TokenBucket(plugin.OUTBOUND_GLOBAL_RATE, plugin.OUTBOUND_GLOBAL_BURST, now)
+        self._chats = {}
+        self.calls = 0
+        self.flood_errors = 0
+
+    def _limit(self, chat_id):
+        with self._lock:
+            self.calls += 1
+            now = time.monotonic()
+            chat = self._chats.setdefault(chat_id, plugin.TokenBucket(plugin.OUTBOUND_CHAT_RATE, plugin.OUTBOUND_CHAT_BURST, now))
+            delay = max(chat.delay(now), self._global.delay(now))
+            if delay:
+                self.flood_errors += 1
+                raise TooManyRequests(math.ceil(delay))
+            chat.take()
+            self._global.take()
+        time.sleep(API_LATENCY)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._limit(chat_id)
+        return text
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._limit(chat_id)
+        return text
+
+
+def messages(chat_id: int):
+    """(текст, параметры, приоритет) сообщений чата."""
+    if chat_id % 2:
+        return [("💰 Чистая выгода: <code>571.97</code> RUB", {"reply_markup": "{}", "parse_mode": "HTML"}, plugin.PRIORITY_QUOTE)]
+    # set_rate: подтверждение и сразу главное меню
+    return [
+        ("✅ Курс <b>USD</b> успешно обновлён!", {"parse_mode": "HTML"}, plugin.PRIORITY_DEFAULT),
+        (plugin.generate_main_message(), {"reply_markup": "{}", "parse_mode": "HTML"}, plugin.PRIORITY_MENU),
+    ]
+
+
+def flow(bot, chat_id: int, futures: list):
+    for text, kwargs, priority in messages(chat_id):
+        futures.append(bot.send_message(chat_id, text, priority=priority, **kwargs))
+
+
+def run_direct(chats: int):
+    bot = FloodBot()
+    failed = 0
+
+    def direct_flow(chat_id):
+        nonlocal failed
+        for text, kwargs, _ in messages(chat_id):
+            try:
+                bot.send_message(chat_id, text, **kwargs)
+            except TooManyRequests:
+                failed += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=TELEBOT_THREADS) as pool:
+        for chat_id in range(1, chats + 1):
+            pool.submit(direct_flow, chat_id)
+    return bot, time.perf_counter() - start, failed
+
+
+def run_scheduled(chats: int):
+    bot = FloodBot()
+    metrics = plugin.Metrics()
+    scheduler = plugin.OutboundScheduler(metrics)
+    plugin.OUTBOUND_SCHEDULER = True
+    scheduler.start(bot)
+    futures = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=TELEBOT_THREADS) as pool:
+        for chat_id in range(1, chats + 1):
+            pool.submit(flow, scheduler, chat_id, futures)
+    wait(futures)
+    failed = sum(1 for future in futures if future.exception() is not None)
+    return bot, time.perf_counter() - start, failed, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=80)
+    args = parser.parse_args()
+    total = sum(len(messages(chat_id)) for chat_id in range(1, args.chats + 1))
+
+    bot, elapsed, failed = run_direct(args.chats)
+    print(
+        f"без планировщика: {total} сообщений за {elapsed:5.2f} с, "
+        f"{bot.calls} вызовов API, 429: {bot.flood_errors}, потеряно: {failed}"
+    )
+    bot, elapsed, failed, metrics = run_scheduled(args.chats)
+    print(
+        f"с планировщиком:  {total} сообщений за {elapsed:5.2f} с, "
+        f"{bot.calls} вызовов API, 429: {bot.flood_errors}, потеряно: {failed}, "
+        f"склеено: {metrics.counters.get('outbound.merged', 0)}"
+    )
+    for priority in ("quote", "default", "menu"):
+        histogram = metrics.histograms.get(f"outbound.wait.{priority}")
+        if histogram is not None and histogram.count:
+            print(
+                f"  ожидание {priority:<8} p50 {histogram.percentile(0.5) * 1e3:7.1f} мс, "
+                f"p95 {histogram.percentile(0.95) * 1e3:7.1f} мс, max {histogram.peak * 1e3:7.1f} мс"
+            )
+
+
+if __name__ == "__main__":
+    main()
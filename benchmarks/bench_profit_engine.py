@@ -0,0 +1,66 @@
+"""Бенчмарк пакетного расчёта выгоды: стоимость одного лота на 1, 1k и 1M лотов
+во float и в точном режиме EXACT_MONEY.
+
+    python benchmarks/bench_profit_engine.py [--budget-ns 10000]
+
+С --budget-ns скрипт завершается с кодом 1, если надбавка точного режима к
+расчёту во float на каком-либо размере пачки превысила бюджет (нс на лот).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+# Курсы передаются явно: бенчмарк не читает файлы курсов и общий файл других экземпляров
+RATES = {"RUB": 5.5289, "UAH": 0.438, "BRL": 3.5, "USD": 18.65}
+
+
+def make_lots(count: int):
+    rnd = random.Random(count)
+    lot_prices = [rnd.uniform(100, 5000) for _ in range(count)]
+    action_prices = [rnd.uniform(1, 500) for _ in range(count)]
+    currencies = [rnd.choice(("uah", "brl", "usd")) for _ in range(count)]
+    modes = [rnd.choice(tuple(plugin.game_registry.mode_factors)) for _ in range(count)]
+    return lot_prices, action_prices, currencies, modes
+
+
+def bench(count: int, exact: bool, repeat: int = 5):
+    lots = make_lots(count)
+    plugin.EXACT_MONEY = exact
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        plugin.calculate_profits(*lots, rates=RATES)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ns", type=float, default=None, help="бюджет надбавки точного режима, нс на лот")
+    args = parser.parse_args()
+
+    # Точный режим (копейки и целые курсы) сравнивается с расчётом во float
+    failed = False
+    for count in (1, 1_000, 1_000_000):
+        repeat = 3 if count >= 1_000_000 else 50
+        float_total = bench(count, exact=False, repeat=repeat)
+        exact_total = bench(count, exact=True, repeat=repeat)
+        overhead_ns = (exact_total - float_total) / count * 1e9
+        print(
+            f"{count:>9} лотов: float {float_total / count * 1e9:8.1f} нс/лот, "
+            f"exact {exact_total / count * 1e9:8.1f} нс/лот "
+            f"(+{overhead_ns:.1f} нс, x{exact_total / float_total:.2f})"
+        )
+        if args.budget_ns is not None and overhead_ns > args.budget_ns:
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
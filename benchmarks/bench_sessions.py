@@ -0,0 +1,210 @@
+"""Прогон записанных сценариев оператора через настоящие обработчики main().
+
+Вместо cardinal.telegram.bot подставляется RecorderBot: он хранит
+зарегистрированные обработчики, запоминает отправленные сообщения и кнопки и
+сам раздаёт синтетические Message/CallbackQuery. Для каждого сценария
+выводятся пропускная способность обработчиков, выделения памяти на один прогон
+(tracemalloc) и рост числа незавершённых диалогов и alternate_commission_states.
+
+    python benchmarks/bench_sessions.py [--flows 2000] [--budget-us 500]
+
+С --budget-us скрипт завершается с кодом 1, если среднее время обработчика в
+каком-либо сценарии превысило бюджет, — так его можно использовать как гейт.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Плагин пишет курсы и журнал в текущую папку: бенчмарк работает во временной
+os.chdir(tempfile.mkdtemp(prefix="rate-calculator-bench-"))
+
+import rate_calculator_plugin as plugin
+
+_ids = itertools.count(1)
+
+
+class RecorderBot:
+    """Бот в памяти: обработчики вызываются синхронно, ответы записываются."""
+
+    def __init__(self):
+        self.message_handlers = []
+        self.callback_handlers = []
+        self.last_message = {}
+        self.sent = 0
+        self.handler_calls = 0
+
+    def register_message_handler(self, handler, commands=None, func=None, **kwargs):
+        self.message_handlers.append((handler, commands, func))
+
+    def register_callback_query_handler(self, handler, func=None, **kwargs):
+        self.callback_handlers.append((handler, func))
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        message = SimpleNamespace(id=next(_ids), chat=SimpleNamespace(id=chat_id), text=text, reply_markup=reply_markup)
+        self.last_message[chat_id] = message
+        self.sent += 1
+        return message
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        message = SimpleNamespace(id=message_id, chat=SimpleNamespace(id=chat_id), text=text, reply_markup=reply_markup)
+        self.last_message[chat_id] = message
+        self.sent += 1
+        return message
+
+    def answer_callback_query(self, *args, **kwargs):
+        return True
+
+    # Синтетические обновления от оператора
+    def text(self, chat_id: int, text: str):
+        self.handler_calls += 1
+        message = SimpleNamespace(
+            id=next(_ids), chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(id=chat_id),
+            text=text, content_type="text", document=None,
+        )
+        if text.startswith("/"):
+            command = text[1:].split()[0]
+            for handler, commands, _ in self.message_handlers:
+                if commands and command in commands:
+                    return handler(message)
+        for handler, commands, func in self.message_handlers:
+            if not commands and (func is None or func(message)):
+                return handler(message)
+
+    def press(self, chat_id: int, data: str = None, index: int = None):
+        """Нажимает кнопку последнего сообщения чата: по callback_data или по номеру."""
+        self.handler_calls += 1
+        message = self.last_message[chat_id]
+        if data is None:
+            data = self.buttons(message)[index]
+        call = SimpleNamespace(id=str(next(_ids)), data=data, from_user=SimpleNamespace(id=chat_id), message=message)
+        for handler, func in self.callback_handlers:
+            if func is None or func(call):
+                return handler(call)
+        raise LookupError(f"Нет обработчика для кнопки {data}")
+
+    @staticmethod
+    def buttons(message):
+        markup = message.reply_markup
+        if isinstance(markup, str):
+            return [button["callback_data"] for row in json.loads(markup)["inline_keyboard"] for button in row]
+        return [button.callback_data for row in markup.keyboard for button in row]
+
+
+def flow_rate_update(bot: RecorderBot, chat_id: int):
+    bot.text(chat_id, "/rate")
+    bot.press(chat_id, "update_rates")
+    bot.press(chat_id, "update_uah")
+    bot.text(chat_id, "100")
+    bot.text(chat_id, f"{228 + chat_id % 7}.5")
+    bot.press(chat_id, "update_rates")
+    bot.press(chat_id, "update_usd")
+    bot.text(chat_id, f"18.{60 + chat_id % 9}")
+
+
+def flow_brawl_quests(bot: RecorderBot, chat_id: int):
+    bot.text(chat_id, "/rate")
+    bot.press(chat_id, "calculate_profit")
+    bot.press(chat_id, plugin.encode_callback("select_game", "brawl", None))
+    bot.text(chat_id, "1000")
+    bot.press(chat_id, index=0)
+    bot.text(chat_id, "50+50")
+    for _ in range(4):
+        bot.press(chat_id, index=0)
+
+
+def flow_clash_recalculate(bot: RecorderBot, chat_id: int):
+    bot.text(chat_id, "/rate")
+    bot.press(chat_id, "calculate_profit")
+    bot.press(chat_id, plugin.encode_callback("select_game", "clash", None))
+    bot.text(chat_id, "500")
+    bot.press(chat_id, index=2)
+    bot.text(chat_id, "2")
+    for lot_price in ("700", "650", "600"):
+        bot.press(chat_id, index=1)
+        bot.text(chat_id, lot_price)
+
+
+FLOWS = {
+    "rate_update": flow_rate_update,
+    "brawl_quests": flow_brawl_quests,
+    "clash_recalculate": flow_clash_recalculate,
+}
+
+
+def setup() -> RecorderBot:
+    # Ответы нужны сразу и без лимитов Telegram: планировщик исходящих отключён
+    plugin.OUTBOUND_SCHEDULER = False
+    # Бенчмарк не пишет в общий файл курсов, даже если он включён: курсы запущенных ботов не меняются
+    plugin.shared_rates = None
+    bot = RecorderBot()
+    cardinal = SimpleNamespace(telegram=SimpleNamespace(bot=bot), add_telegram_commands=lambda *args: None)
+    plugin.main(cardinal)
+    return bot
+
+
+def run(name: str, flow, bot: RecorderBot, count: int, first_chat_id: int):
+    # Каждый прогон — отдельный оператор, как при множестве пользователей бота
+    sessions_before = len(plugin.conversation_store), len(plugin.alternate_commission_states)
+    calls_before = bot.handler_calls
+    start = time.perf_counter()
+    for chat_id in range(first_chat_id, first_chat_id + count):
+        flow(bot, chat_id)
+    elapsed = time.perf_counter() - start
+    calls = bot.handler_calls - calls_before
+    sessions_after = len(plugin.conversation_store), len(plugin.alternate_commission_states)
+
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    for chat_id in range(first_chat_id + count, first_chat_id + count + 100):
+        flow(bot, chat_id)
+    stats = tracemalloc.take_snapshot().compare_to(snapshot, "filename")
+    tracemalloc.stop()
+    allocations = sum(stat.count_diff for stat in stats if stat.count_diff > 0) / 100
+    retained = sum(stat.size_diff for stat in stats) / 100
+
+    return {
+        "flow": name,
+        "handlers_per_second": calls / elapsed,
+        "us_per_handler": elapsed / calls * 1e6,
+        "allocations_per_flow": allocations,
+        "retained_bytes_per_flow": retained,
+        "conversations_growth": sessions_after[0] - sessions_before[0],
+        "commission_states_growth": sessions_after[1] - sessions_before[1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flows", type=int, default=2000, help="прогонов каждого сценария")
+    parser.add_argument("--budget-us", type=float, default=None, help="бюджет на один обработчик, мкс")
+    args = parser.parse_args()
+
+    bot = setup()
+    failed = False
+    for number, (name, flow) in enumerate(FLOWS.items(), 1):
+        result = run(name, flow, bot, args.flows, number * 10_000_000)
+        print(
+            f"{name:<18} {result['handlers_per_second']:>9.0f} обработчиков/с "
+            f"({result['us_per_handler']:6.1f} мкс), "
+            f"{result['allocations_per_flow']:7.1f} выделений/прогон, "
+            f"{result['retained_bytes_per_flow']:8.0f} Б остаётся/прогон, "
+            f"conversations +{result['conversations_growth']}, "
+            f"commission_states +{result['commission_states_growth']}"
+        )
+        if args.budget_us is not None and result["us_per_handler"] > args.budget_us:
+            failed = True
+    plugin.rate_scheduler.stop()
+    plugin.flush_exchange_rates()
+    plugin.profit_ledger.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,31 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from cardinal import Cardinal
+    from telebot.types import Message, InlineKeyboardMarkup
 
-import telebot
-from telebot.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-
+# telebot, asyncio, urllib и concurrent.futures импортируются там, где нужны:
+# Cardinal импортирует плагин при запуске, даже если Telegram-бот выключен
+import atexit
+import base64
+import csv
+import functools
+import heapq
+import html
+import itertools
 import json
+import math
+import mmap
 import os
+import random
+import re
+import struct
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from decimal import ROUND_HALF_UP, Decimal
 
 # Метаданные плагина
 NAME = "Rate Calculator Plugin"
@@ -17,944 +36,2816 @@ CREDITS = "@ta1mez"
 UUID = "c76d42ea-5128-4f67-8a13-7d8c9a0bfa33"
 SETTINGS_PAGE = False
 
+# Валюты. Курсы хранятся относительно базовой валюты BASE_CURRENCY (MDL):
+# обычный курс — сколько MDL стоит единица валюты, обратный (inverse) — сколько
+# единиц валюты дают за 1 MDL. Ввод курса: "direct" — одно число,
+# "pair" — два числа из prompts, курс равен их частному.
+BASE_CURRENCY = "MDL"
+CURRENCY_CONFIG = {
+    "MDL": {"flag": "🇲🇩", "name": "Леи", "precision": 2},
+    "RUB": {
+        "flag": "🇷🇺", "name": "Рубли", "precision": 4, "default": 5.5289, "inverse": True, "input": "pair",
+        "prompts": ["🟢 По какому курсу куплены USDT?", "🔴 По какому курсу проданы USDT?"],
+        "errors": ["корректный курс покупки USDT", "корректный курс продажи USDT"],
+    },
+    "UAH": {
+        "flag": "🇺🇦", "name": "Гривны", "precision": 4, "default": 0.4380, "input": "pair",
+        "prompts": ["🇲🇩 Какая сумма последней транзакции в леях?", "🇺🇦 Какая сумма этой транзакции в гривнах?"],
+        "errors": ["корректную сумму в леях", "корректную сумму в гривнах"],
+    },
+    "BRL": {
+        "flag": "🇧🇷", "name": "Реалы", "precision": 4, "default": 3.5000, "input": "pair",
+        "prompts": ["🇲🇩 Какая сумма последней транзакции в леях?", "🇧🇷 Какая сумма этой транзакции в реалах?"],
+        "errors": ["корректную сумму в леях", "корректную сумму в реалах"],
+    },
+    "USD": {
+        "flag": "🇺🇲", "name": "Доллары", "precision": 2, "default": 18.65, "input": "direct",
+        "prompts": ["🇺🇲 Какой курс <b>USD - MDL</b>?"],
+        "errors": ["корректный курс USD - MDL"],
+    },
+}
+
+class Currency:
+    """Описание валюты: код, флаг, точность отображения и способ ввода курса."""
+
+    __slots__ = ("code", "index", "flag", "name", "precision", "default", "inverse", "input", "prompts", "errors")
+
+    def __init__(self, code: str, index: int, config: dict):
+        self.code = code
+        self.index = index
+        self.flag = config["flag"]
+        self.name = config["name"]
+        self.precision = config.get("precision", 4)
+        self.default = config.get("default", 1.0)
+        self.inverse = config.get("inverse", False)
+        self.input = config.get("input")
+        self.prompts = tuple(config.get("prompts", ()))
+        self.errors = tuple(config.get("errors", ()))
+
+    @property
+    def label(self) -> str:
+        """Подпись курса: "UAH - MDL" или, для обратного курса, "MDL - RUB"."""
+        return f"{BASE_CURRENCY} - {self.code}" if self.inverse else f"{self.code} - {BASE_CURRENCY}"
+
+    @property
+    def unit(self) -> str:
+        return self.code if self.inverse else BASE_CURRENCY
+
+    def to_base(self, rate: float) -> float:
+        """Стоимость единицы валюты в базовой валюте."""
+        return 1 / rate if self.inverse else rate
+
+def is_valid_rate(rate) -> bool:
+    """Курс — конечное положительное число (ноль и nan сломали бы кросс-курсы)."""
+    return isinstance(rate, (int, float)) and math.isfinite(rate) and rate > 0
+
+def parse_number(text: str, positive: bool = False) -> float:
+    """float(text) только для конечных чисел (при positive — ещё и больше нуля), иначе ValueError."""
+    value = float(text)
+    if not math.isfinite(value) or (positive and value <= 0):
+        raise ValueError(f"Некорректное число: {text}")
+    return value
+
+# Плотный индекс валют: порядок CURRENCY_CONFIG задаёт номер строки/столбца в матрице кросс-курсов
+CURRENCIES = {code: Currency(code, index, config) for index, (code, config) in enumerate(CURRENCY_CONFIG.items())}
+RATE_CURRENCIES = tuple(currency for currency in CURRENCIES.values() if currency.input)
+
+class CrossRates:
+    """Вектор стоимостей валют в базовой валюте и матрица кросс-курсов N×N.
+
+    matrix[i][j] — сколько единиц валюты j дают за единицу валюты i. При смене
+    одного курса пересчитываются только его строка и столбец.
+    """
+
+    def __init__(self, rates: dict):
+        self.values = [1.0] * len(CURRENCIES)
+        for code, rate in rates.items():
+            if code in CURRENCIES and code != BASE_CURRENCY:
+                self.values[CURRENCIES[code].index] = CURRENCIES[code].to_base(rate)
+        self.matrix = [[value / other for other in self.values] for value in self.values]
+
+    def update(self, code: str, rate: float):
+        currency = CURRENCIES.get(code)
+        if currency is None or code == BASE_CURRENCY:
+            return
+        i = currency.index
+        # Строка и столбец считаются до изменения: при ошибке матрица остаётся прежней
+        values = self.values.copy()
+        value = values[i] = currency.to_base(rate)
+        if not math.isfinite(value) or value <= 0:
+            raise ValueError(f"Некорректный курс {code}: {rate}")
+        row = [value / other for other in values]
+        column = [other / value for other in values]
+        self.values = values
+        for j, other in enumerate(column):
+            self.matrix[j][i] = other
+        self.matrix[i] = row
+
+    def rate(self, source: str, target: str) -> float:
+        """Сколько единиц target дают за единицу source."""
+        return self.matrix[CURRENCIES[source].index][CURRENCIES[target].index]
+
+    def convert(self, amount: float, source: str, target: str) -> float:
+        return amount * self.matrix[CURRENCIES[source].index][CURRENCIES[target].index]
+
+# Метрики: гистограммы задержек обработчиков, вызовов Bot API и записи курсов.
+# Если METRICS_FILE задан, метрики периодически пишутся в текстовом формате Prometheus.
+METRICS_FILE = None  # например, "rate_calculator_metrics.prom"
+METRICS_EXPORT_INTERVAL = 15.0
+
+class LatencyHistogram:
+    """Гистограмма задержек в духе HDR: фиксированная память, погрешность квантилей до 1/16.
+
+    Значения в микросекундах; до 32 мкс корзины по 1 мкс, дальше на каждую
+    степень двойки приходится 16 корзин одинаковой ширины.
+    """
+
+    SUB_BUCKETS = 16
+    BUCKETS = 400  # до ~10^8 мкс (100 с), большие значения попадают в последнюю корзину
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        if micros < 2 * cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 5
+        return min((shift + 1) * cls.SUB_BUCKETS + (micros >> shift) - cls.SUB_BUCKETS, cls.BUCKETS - 1)
+
+    @classmethod
+    def _bounds(cls, index: int):
+        """Границы корзины [low, high) в микросекундах."""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index, index + 1
+        shift = index // cls.SUB_BUCKETS - 1
+        low = (index % cls.SUB_BUCKETS + cls.SUB_BUCKETS) << shift
+        return low, low + (1 << shift)
+
+    def record(self, seconds: float):
+        index = self._index(int(seconds * 1e6))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.peak:
+                self.peak = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Квантиль в секундах (середина корзины)."""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = max(1, round(fraction * self.count))
+            seen = 0
+            for index, bucket in enumerate(self.counts):
+                seen += bucket
+                if seen >= rank:
+                    low, high = self._bounds(index)
+                    return min((low + high) / 2e6, self.peak)
+        return self.peak
+
+class Metrics:
+    """Именованные гистограммы задержек и счётчики."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def observe(self, name: str, seconds: float):
+        self.histogram(name).record(seconds)
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed(self, name: str = None):
+        """Декоратор: время каждого вызова функции попадает в гистограмму name."""
+        def decorator(func):
+            histogram_name = name or f"handler.{func.__name__}"
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(histogram_name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def render_prometheus(self) -> str:
+        lines = ["# TYPE rate_calculator_latency_seconds summary"]
+        for name, histogram in sorted(self.histograms.items()):
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(f'rate_calculator_latency_seconds{{name="{name}",quantile="{quantile}"}} {histogram.percentile(quantile):.6f}')
+            lines.append(f'rate_calculator_latency_seconds_sum{{name="{name}"}} {histogram.total:.6f}')
+            lines.append(f'rate_calculator_latency_seconds_count{{name="{name}"}} {histogram.count}')
+        lines.append("# TYPE rate_calculator_events_total counter")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'rate_calculator_events_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        """Атомарно записывает метрики в файл для textfile-коллектора Prometheus."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".metrics_", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+class MetricsExporter:
+    """Фоновая периодическая выгрузка метрик в METRICS_FILE."""
+
+    def __init__(self, metrics: Metrics, interval: float):
+        self.metrics = metrics
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not METRICS_FILE:
+            return
+        self._thread = threading.Thread(target=self._run, name="rate-calculator-metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self, *args):
+        self._stop.set()
+        if self._thread is not None:
+            self._export()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._export()
+
+    def _export(self):
+        try:
+            self.metrics.export(METRICS_FILE)
+        except Exception as e:
+            print(f"Ошибка при выгрузке метрик: {e}")
+
+class InstrumentedBot:
+    """Обёртка бота: считает и замеряет вызовы Bot API (api.<метод>), ошибки — в счётчиках."""
+
+    TIMED = ("send_message", "edit_message_text", "answer_callback_query")
+
+    def __init__(self, bot, metrics: Metrics):
+        self._bot = bot
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self._bot, name)
+        if name in self.TIMED:
+            return functools.partial(self._call, name, attribute)
+        return attribute
+
+    def _call(self, name: str, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            self._metrics.increment(f"api.{name}.errors")
+            raise
+        finally:
+            self._metrics.observe(f"api.{name}", time.perf_counter() - start)
+
+metrics = Metrics()
+metrics_exporter = MetricsExporter(metrics, METRICS_EXPORT_INTERVAL)
+
+def render_metrics_table(fractions=(0.5, 0.95, 0.99)) -> str:
+    """Таблица квантилей задержек в миллисекундах для /rate_stats."""
+    header = f"{'Метрика':<28} {'N':>6} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}"
+    rows = []
+    for name, histogram in sorted(metrics.histograms.items(), key=lambda item: -item[1].count):
+        if not histogram.count:
+            continue
+        quantiles = " ".join(f"{histogram.percentile(fraction) * 1e3:>7.2f}" for fraction in fractions)
+        rows.append(f"{name[:28]:<28} {histogram.count:>6} {quantiles} {histogram.peak * 1e3:>7.2f}")
+    counters = "".join(f"\n• {html.escape(name)}: <code>{value}</code>" for name, value in sorted(metrics.counters.items()))
+    return (
+        "<b>⏱ Задержки, мс:</b>\n"
+        f"<pre>{header}\n" + ("\n".join(rows) or "нет данных") + "</pre>" + counters
+    )
+
 # Имя файла для хранения курсов
 RATES_FILE = "exchange_rates.json"
+# Пауза (в секундах), за которую серия обновлений склеивается в одну запись
+RATES_FLUSH_INTERVAL = 1.0
+
+class RatesWriter:
+    """Фоновая запись курсов: склеивает частые обновления в одну атомарную запись файла."""
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._dirty = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.written_mtime = None
+
+    @property
+    def pending(self) -> bool:
+        """Есть изменения, ещё не записанные на диск."""
+        return self._dirty.is_set()
+
+    def schedule(self):
+        """Помечает курсы изменёнными; запись произойдёт в фоне."""
+        self._dirty.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="rate-calculator-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Немедленно записывает курсы, если есть несохранённые изменения."""
+        with self._lock:
+            if not self._dirty.is_set():
+                return
+            self._dirty.clear()
+            data = dict(exchange_rates)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            start = time.perf_counter()
+            try:
+                fd, tmp_path = tempfile.mkstemp(prefix=".rates_", suffix=".tmp", dir=directory)
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(data, f, ensure_ascii=False, indent=4)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.path)
+                    self.written_mtime = os.stat(self.path).st_mtime_ns
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            except Exception as e:
+                metrics.increment("rates.write.errors")
+                print(f"Ошибка при сохранении курсов: {e}")
+            finally:
+                metrics.observe("rates.write", time.perf_counter() - start)
+
+class RateProvider(ABC):
+    """Источник курсов для фонового обновления.
+
+    fetch() возвращает словарь {валюта: курс} (можно неполный) или None, если
+    данные не изменились. ttl — период обновления в секундах, jitter — доля
+    случайного разброса периода, чтобы источники не опрашивались одновременно.
+    """
 
+    name = "provider"
+    # Источник сам хранит курсы: полученные из него изменения не сохраняются в файл
+    stores_rates = False
+
+    def __init__(self, ttl: float = 300.0, jitter: float = 0.1):
+        self.ttl = ttl
+        self.jitter = jitter
+        self.last_success = None
+        self.failures = 0
+
+    @abstractmethod
+    def fetch(self):
+        """Возвращает {валюта: курс} или None, если ничего не изменилось."""
+
+    def next_delay(self) -> float:
+        return self.ttl * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    @property
+    def stale(self) -> bool:
+        """Курсы источника устарели: успешного обновления не было дольше двух периодов."""
+        return self.last_success is None or time.monotonic() - self.last_success > 2 * self.ttl
+
+class JsonFileRateProvider(RateProvider):
+    """Файл exchange_rates.json: загрузка при старте, перечитывание при изменении и сохранение."""
+
+    name = "json"
+    stores_rates = True
+
+    def __init__(self, path: str, writer: RatesWriter, ttl: float = 5.0, jitter: float = 0.1):
+        super().__init__(ttl, jitter)
+        self.path = path
+        self.writer = writer
+        self._mtime = None
+
+    def fetch(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        # Свои записи и файл, который вот-вот перезапишется из памяти, не перечитываем
+        if mtime in (self._mtime, self.writer.written_mtime) or self.writer.pending:
+            self._mtime = mtime
+            return None
+        with open(self.path, "r", encoding="utf-8") as f:
+            rates = json.load(f)
+        self._mtime = mtime
+        return rates
+
+    def load(self) -> dict:
+        """Загружает курсы валют из файла."""
+        # Исходные значения нужны, если файла нет, он повреждён или в нём нет новой валюты
+        rates = {currency.code: currency.default for currency in RATE_CURRENCIES}
+        try:
+            rates.update(self.fetch() or {})
+        except Exception as e:
+            print(f"Ошибка при загрузке курсов: {e}")
+        return rates
+
+    def save(self):
+        self.writer.schedule()
+
+class HttpRateProvider(RateProvider):
+    """JSON вида {"USD": 18.65, ...} по HTTP (например, локальный сервис курсов)."""
+
+    name = "http"
+
+    def __init__(self, url: str, ttl: float = 300.0, jitter: float = 0.1, timeout: float = 5.0):
+        super().__init__(ttl, jitter)
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        import urllib.request
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+            return {currency.upper(): float(rate) for currency, rate in json.load(response).items()}
+
+class CsvFolderRateProvider(RateProvider):
+    """Папка, куда кладут CSV-файлы со строками "валюта,курс"; берётся самый свежий файл."""
+
+    name = "csv"
+
+    def __init__(self, folder: str, ttl: float = 30.0, jitter: float = 0.1):
+        super().__init__(ttl, jitter)
+        self.folder = folder
+        self._seen = None
+
+    def fetch(self):
+        files = [entry for entry in os.scandir(self.folder) if entry.name.endswith(".csv") and entry.is_file()]
+        if not files:
+            return None
+        newest = max(files, key=lambda entry: entry.stat().st_mtime_ns)
+        marker = (newest.path, newest.stat().st_mtime_ns)
+        if marker == self._seen:
+            return None
+        rates = {}
+        with open(newest.path, "r", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) >= 2 and row[0].strip() and not row[0].startswith("#"):
+                    rates[row[0].strip().upper()] = float(row[1].replace(",", "."))
+        self._seen = marker
+        return rates
+
+# Общий для нескольких экземпляров Cardinal на одной машине файл курсов (mmap).
+# По умолчанию выключен. Чтобы включить, укажите абсолютный путь в папке, куда
+# может писать только пользователь бота (не /tmp): курсы из файла попадают во
+# все расчёты, а файл другого пользователя не открывается
+SHARED_RATES_FILE = None
+# Период (в секундах) проверки изменений от других экземпляров
+SHARED_RATES_POLL_INTERVAL = 0.2
+
+class SharedRates:
+    """Курсы в общем для процессов файле фиксированного размера, отображённом в память.
+
+    Писатель берёт блокировку файла (lockf) и ведёт seqlock: счётчик seq
+    нечётный, пока идёт запись. Читатели не блокируются: копируют слоты и
+    повторяют, если seq был нечётным или изменился. Версия — чтение 8 байт.
+    """
+
+    HEADER = struct.Struct("<4sHHQd")  # сигнатура, формат, число слотов, seq, время записи
+    SLOT = struct.Struct("<4sd")  # валюта, курс
+    SEQUENCE = struct.Struct("<Q")
+    SEQUENCE_OFFSET = 8
+    MAGIC = b"RTSH"
+    LAYOUT = 1
+    SLOTS = 16
+    SIZE = HEADER.size + SLOTS * SLOT.size
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._mmap = None
+        self._fcntl = None
+        self._lock = threading.Lock()
+
+    def _view(self):
+        if self._mmap is None:
+            with self._lock:
+                self._open()
+        return self._mmap
+
+    def _open(self):
+        if self._mmap is not None:
+            return
+        try:
+            import fcntl
+        except ImportError:  # Windows: запись защищена только внутри процесса
+            fcntl = None
+        self._fcntl = fcntl
+        # Симлинк и чужой файл отвергаются: иначе курсы мог бы подложить любой пользователь машины
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            if hasattr(os, "getuid") and os.fstat(fd).st_uid != os.getuid():
+                raise PermissionError(f"Общий файл курсов {self.path} принадлежит другому пользователю")
+            self._lock_file(fd, True)
+            try:
+                if os.fstat(fd).st_size < self.SIZE:
+                    os.ftruncate(fd, self.SIZE)
+                view = mmap.mmap(fd, self.SIZE)
+                if self.HEADER.unpack_from(view)[:3] != (self.MAGIC, self.LAYOUT, self.SLOTS):
+                    view[:] = bytes(self.SIZE)
+                    self.HEADER.pack_into(view, 0, self.MAGIC, self.LAYOUT, self.SLOTS, 0, 0.0)
+            finally:
+                self._lock_file(fd, False)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd, self._mmap = fd, view
+
+    def _lock_file(self, fd: int, lock: bool):
+        if self._fcntl is not None:
+            # lockf, а не flock: блокировка принадлежит процессу и не делится с форками
+            self._fcntl.lockf(fd, self._fcntl.LOCK_EX if lock else self._fcntl.LOCK_UN)
+
+    @property
+    def sequence(self) -> int:
+        """Номер записи: меняется при каждом изменении курсов любым экземпляром."""
+        return self.SEQUENCE.unpack_from(self._view(), self.SEQUENCE_OFFSET)[0]
+
+    def _parse(self, data: bytes):
+        updated_at = self.HEADER.unpack_from(data)[4]
+        rates = {}
+        for offset in range(self.HEADER.size, self.SIZE, self.SLOT.size):
+            code, rate = self.SLOT.unpack_from(data, offset)
+            if not code[0]:
+                break
+            rates[code.rstrip(b"\0").decode()] = rate
+        return updated_at, rates
+
+    def snapshot(self):
+        """Согласованная копия без блокировок: (seq, время записи, {валюта: курс})."""
+        view = self._view()
+        for _ in range(1000):
+            sequence = self.SEQUENCE.unpack_from(view, self.SEQUENCE_OFFSET)[0]
+            if not sequence & 1:
+                data = view[:]
+                if self.SEQUENCE.unpack_from(view, self.SEQUENCE_OFFSET)[0] == sequence:
+                    return (sequence, *self._parse(data))
+            time.sleep(0)
+        # Писатель упал посреди записи: под блокировкой seq уже никто не меняет
+        with self._lock:
+            self._lock_file(self._fd, True)
+            try:
+                sequence = self.SEQUENCE.unpack_from(view, self.SEQUENCE_OFFSET)[0]
+                if sequence & 1:
+                    sequence += 1
+                    self.SEQUENCE.pack_into(view, self.SEQUENCE_OFFSET, sequence)
+                return (sequence, *self._parse(view[:]))
+            finally:
+                self._lock_file(self._fd, False)
+
+    def publish(self, rates: dict) -> bool:
+        """Записывает курсы для всех экземпляров; False, если они уже совпадали."""
+        if all(self.snapshot()[2].get(currency) == rate for currency, rate in rates.items()):
+            return False
+        start = time.perf_counter()
+        with self._lock:
+            view = self._mmap
+            self._lock_file(self._fd, True)
+            try:
+                sequence = self.SEQUENCE.unpack_from(view, self.SEQUENCE_OFFSET)[0] | 1
+                current = self._parse(view[:])[1]
+                current.update(rates)
+                if len(current) > self.SLOTS:
+                    raise ValueError(f"В общем файле курсов помещается не больше {self.SLOTS} валют")
+                self.SEQUENCE.pack_into(view, self.SEQUENCE_OFFSET, sequence)
+                for index, (currency, rate) in enumerate(current.items()):
+                    self.SLOT.pack_into(view, self.HEADER.size + index * self.SLOT.size, currency.encode()[:4], rate)
+                self.HEADER.pack_into(view, 0, self.MAGIC, self.LAYOUT, self.SLOTS, sequence, time.time())
+                self.SEQUENCE.pack_into(view, self.SEQUENCE_OFFSET, sequence + 1)
+            finally:
+                self._lock_file(self._fd, False)
+        metrics.observe("rates.shared.publish", time.perf_counter() - start)
+        return True
+
+    def attach(self, rates: dict, saved_at: float = 0.0) -> dict:
+        """Сводит курсы из файла (сохранённого в saved_at) с общими: берёт более свежие.
+
+        Только читает: в общий файл попадают лишь изменения курсов после запуска.
+        """
+        _, updated_at, shared = self.snapshot()
+        if shared and updated_at >= saved_at:
+            return {**rates, **{currency: rate for currency, rate in shared.items() if currency in rates and is_valid_rate(rate)}}
+        return rates
+
+class SharedRatesProvider(RateProvider):
+    """Изменения курсов от других экземпляров Cardinal через SharedRates.
+
+    Проверка — одно чтение счётчика seq, поэтому период можно держать маленьким.
+    """
+
+    name = "shared"
+    stores_rates = True
+
+    def __init__(self, shared: SharedRates, ttl: float = SHARED_RATES_POLL_INTERVAL, jitter: float = 0.0):
+        super().__init__(ttl, jitter)
+        self.shared = shared
+        self._seen = None
+
+    def fetch(self):
+        if self.shared.sequence == self._seen:
+            return None
+        self._seen, _, rates = self.shared.snapshot()
+        return rates
+
+rates_writer = RatesWriter(RATES_FILE, RATES_FLUSH_INTERVAL)
+rates_file_provider = JsonFileRateProvider(RATES_FILE, rates_writer)
+shared_rates = SharedRates(SHARED_RATES_FILE) if SHARED_RATES_FILE else None
+
+@metrics.timed("rates.save")
 def save_exchange_rates():
-    """Сохраняет текущие курсы валют в файл."""
-    try:
-        with open(RATES_FILE, "w", encoding="utf-8") as f:
-            json.dump(exchange_rates, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        print(f"Ошибка при сохранении курсов: {e}")
+    """Ставит текущие курсы валют в очередь на сохранение в файл."""
+    rates_file_provider.save()
+
+def flush_exchange_rates(*args):
+    """Дописывает несохранённые курсы на диск (при остановке Cardinal)."""
+    rates_writer.flush()
 
 def load_exchange_rates():
-    """Загружает курсы валют из файла."""
-    if os.path.exists(RATES_FILE):
+    """Загружает курсы валют из файла и сводит их с общими курсами других экземпляров."""
+    rates = rates_file_provider.load()
+    if shared_rates is not None:
         try:
-            with open(RATES_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            saved_at = os.path.getmtime(RATES_FILE) if os.path.exists(RATES_FILE) else 0.0
+            rates = shared_rates.attach(rates, saved_at)
         except Exception as e:
-            print(f"Ошибка при загрузке курсов: {e}")
-    return {
-        "RUB": 5.5289,
-        "UAH": 0.4380,
-        "BRL": 3.5000,  # Добавлены бразильские реалы с 4 цифрами после точки
-        "USD": 18.65
-    }  # Возвращаем исходные значения, если файл не найден или поврежден
+            print(f"Ошибка при подключении общего файла курсов: {e}")
+    return rates
 
-exchange_rates = load_exchange_rates()
+class RateStore(MutableMapping):
+    """Курсы валют с номером версии: каждое изменение увеличивает version и оповещает подписчиков.
 
-# Словарь для хранения последних запросов
-last_requests = {}
-alternate_commission_states = {}
+    Матрица кросс-курсов (cross) обновляется вместе с курсом. Курсы загружаются
+    функцией loader при первом обращении, а не при импорте плагина.
+    """
 
-# Генерация стартового сообщения
-def generate_main_message():
+    def __init__(self, loader):
+        self._loader = loader
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.version = 0
+
+    def __getattr__(self, name):
+        # Вызывается, только пока _rates и cross ещё не загружены
+        if name not in ("_rates", "cross"):
+            raise AttributeError(name)
+        with self._load_lock:
+            if "_rates" not in self.__dict__:
+                rates = dict(self._loader())
+                self.cross = CrossRates(rates)
+                self._rates = rates
+        return self.__dict__[name]
+
+    def __getitem__(self, currency: str) -> float:
+        return self._rates[currency]
+
+    def __setitem__(self, currency: str, rate: float):
+        if not is_valid_rate(rate):
+            raise ValueError(f"Некорректный курс {currency}: {rate}")
+        with self._lock:
+            old_rate = self._rates.get(currency)
+            self.cross.update(currency, rate)
+            self._rates[currency] = rate
+            self.version += 1
+        for callback in self._subscribers:
+            try:
+                callback(currency, old_rate, rate)
+            except Exception as e:
+                print(f"Ошибка в подписчике курсов: {e}")
+
+    def __delitem__(self, currency: str):
+        with self._lock:
+            del self._rates[currency]
+            self.version += 1
+
+    def __iter__(self):
+        return iter(self._rates)
+
+    def __len__(self):
+        return len(self._rates)
+
+    def subscribe(self, callback):
+        """Подписывает callback(currency, old_rate, new_rate) на изменения курсов."""
+        self._subscribers.append(callback)
+
+exchange_rates = RateStore(load_exchange_rates)
+atexit.register(flush_exchange_rates)
+def publish_shared_rate(currency: str, old_rate: float, rate: float):
+    # shared_rates = None отключает запись в общий файл и после импорта (так делают бенчмарки)
+    if shared_rates is not None:
+        shared_rates.publish({currency: rate})
+
+exchange_rates.subscribe(publish_shared_rate)
+
+class RateScheduler:
+    """Фоновое обновление курсов из источников.
+
+    Обработчики всегда читают курсы из памяти. Если источник недоступен,
+    остаются последние известные значения (stale-while-revalidate), а повторная
+    попытка делается раньше обычного периода.
+    """
+
+    def __init__(self, store: RateStore, providers):
+        self.store = store
+        self.providers = list(providers)
+        self._due = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not self.providers:
+            return
+        now = time.monotonic()
+        self._due = {provider: now for provider in self.providers}
+        self._thread = threading.Thread(target=self._run, name="rate-calculator-providers", daemon=True)
+        self._thread.start()
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for provider, due in list(self._due.items()):
+                if due <= now:
+                    self.refresh(provider)
+            self._stop.wait(max(0.0, min(self._due.values()) - time.monotonic()))
+
+    def refresh(self, provider: RateProvider):
+        """Опрашивает источник и применяет изменившиеся курсы."""
+        try:
+            rates = provider.fetch()
+        except Exception as e:
+            provider.failures += 1
+            print(f"Ошибка при обновлении курсов ({provider.name}): {e}")
+            self._due[provider] = time.monotonic() + min(provider.next_delay(), 30.0 * provider.failures)
+            return
+        provider.failures = 0
+        provider.last_success = time.monotonic()
+        self._due[provider] = provider.last_success + provider.next_delay()
+        changed = False
+        for currency, rate in (rates or {}).items():
+            if currency in self.store and self.store[currency] != rate:
+                try:
+                    self.store[currency] = rate
+                except ValueError as e:
+                    print(f"Курс от источника {provider.name} пропущен: {e}")
+                    continue
+                changed = True
+        if changed and not provider.stores_rates:
+            save_exchange_rates()
+
+# Источники фонового обновления курсов, например:
+# HttpRateProvider("http://127.0.0.1:8080/rates.json", ttl=300) или CsvFolderRateProvider("rates_inbox")
+RATE_PROVIDERS = [rates_file_provider] + ([SharedRatesProvider(shared_rates)] if shared_rates is not None else [])
+rate_scheduler = RateScheduler(exchange_rates, RATE_PROVIDERS)
+
+def render_provider_status() -> str:
+    """Состояние источников курсов для /rate_stats: при сбое показываются последние известные курсы."""
+    lines = ["<b>🔄 Источники курсов:</b>"]
+    now = time.monotonic()
+    for provider in rate_scheduler.providers:
+        age = "ещё не обновлялся" if provider.last_success is None else f"{now - provider.last_success:.0f} с назад"
+        status = "⚠️ устарел" if provider.stale else "✅"
+        failures = f", ошибок подряд: <code>{provider.failures}</code>" if provider.failures else ""
+        lines.append(f"• {status} <b>{html.escape(provider.name)}</b>: {age}{failures}")
+    return "\n".join(lines)
+
+# Журнал изменений курсов: записи фиксированной длины (время, валюта, курс)
+RATES_HISTORY_FILE = "exchange_rates_history.bin"
+
+class RateHistory:
+    """Только дописываемый журнал курсов, читаемый через mmap.
+
+    Записи упорядочены по времени, поэтому поиск курса на момент времени и
+    выборка интервала делаются двоичным поиском.
+    """
+
+    RECORD = struct.Struct("<d4sd")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._last_timestamp = 0.0
+
+    def append(self, currency: str, rate: float, timestamp: float = None):
+        with self._lock:
+            # Время в журнале не убывает, даже если системные часы перевели назад
+            timestamp = max(time.time() if timestamp is None else timestamp, self._last_timestamp)
+            with open(self.path, "ab") as f:
+                f.write(self.RECORD.pack(timestamp, currency.encode()[:4], rate))
+            self._last_timestamp = timestamp
+
+    def seed(self, rates):
+        """Записывает текущие курсы, если журнал ещё пуст."""
+        if not len(self):
+            for currency, rate in rates.items():
+                self.append(currency, rate)
+
+    def _view(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return None, 0
+        count = size // self.RECORD.size
+        if not count:
+            return None, 0
+        if self._mmap is None or len(self._mmap) < count * self.RECORD.size:
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), count * self.RECORD.size, access=mmap.ACCESS_READ)
+        if count and not self._last_timestamp:
+            self._last_timestamp = self.RECORD.unpack_from(self._mmap, (count - 1) * self.RECORD.size)[0]
+        return self._mmap, count
+
+    def __len__(self):
+        with self._lock:
+            return self._view()[1]
+
+    def _bisect(self, view, count: int, timestamp: float, inclusive: bool = True) -> int:
+        """Индекс первой записи позже timestamp (или не раньше, если inclusive=False)."""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            record_timestamp = self.RECORD.unpack_from(view, middle * self.RECORD.size)[0]
+            if record_timestamp < timestamp or (inclusive and record_timestamp == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, currency: str, start: float, end: float):
+        """Изменения курса валюты в интервале [start, end]: список (время, курс)."""
+        code = currency.upper().encode()
+        with self._lock:
+            view, count = self._view()
+            if view is None:
+                return []
+            first = self._bisect(view, count, start, inclusive=False)
+            last = self._bisect(view, count, end)
+            points = []
+            for index in range(first, last):
+                timestamp, record_code, rate = self.RECORD.unpack_from(view, index * self.RECORD.size)
+                if record_code.rstrip(b"\0") == code:
+                    points.append((timestamp, rate))
+            return points
+
+    def as_of(self, currency: str, timestamp: float):
+        """Курс валюты, действовавший в момент timestamp (или None)."""
+        code = currency.upper().encode()
+        with self._lock:
+            view, count = self._view()
+            if view is None:
+                return None
+            for index in range(self._bisect(view, count, timestamp) - 1, -1, -1):
+                _, record_code, rate = self.RECORD.unpack_from(view, index * self.RECORD.size)
+                if record_code.rstrip(b"\0") == code:
+                    return rate
+            return None
+
+    def ohlc(self, currency: str, start: float, end: float, bucket: float):
+        """Свечи (начало интервала, open, high, low, close) с шагом bucket секунд.
+
+        Интервалы без изменений продолжают предыдущий курс.
+        """
+        points = self.range(currency, start, end)
+        close = self.as_of(currency, start)
+        candles = []
+        position = 0
+        bucket_start = start
+        while bucket_start < end:
+            bucket_end = bucket_start + bucket
+            rates = []
+            while position < len(points) and points[position][0] < bucket_end:
+                rates.append(points[position][1])
+                position += 1
+            opening = close if close is not None else (rates[0] if rates else None)
+            if opening is not None:
+                values = [opening] + rates
+                close = values[-1]
+                candles.append((bucket_start, opening, max(values), min(values), close))
+            bucket_start = bucket_end
+        return candles
+
+rate_history = RateHistory(RATES_HISTORY_FILE)
+exchange_rates.subscribe(lambda currency, old_rate, rate: rate_history.append(currency, rate))
+
+# Игры и комиссии FunPay. Описание можно переопределить файлом GAMES_FILE
+# в том же формате, что и DEFAULT_GAMES; изменения файла подхватываются на лету.
+GAMES_FILE = "rate_calculator_games.json"
+GAMES_RELOAD_INTERVAL = 5.0
+DEFAULT_GAMES = {
+    "brawl": {
+        "title": "🟡 Brawl Stars",
+        "item": "лота",
+        "lot_prompt": "💸 Введите цену лота (для покупателя) в рублях:",
+        "commission": 0.16068374059755964,
+        "payout": 0.97,
+        "modifier": {"key": "quests", "title": "Квесты", "commission": 0.08224296149183244},
+        "currencies": ["uah", "brl", "usd"],
+    },
+    "clash": {
+        "title": "🔴 Clash Royale",
+        "item": "лота",
+        "lot_prompt": "💸 Введите цену лота (для покупателя) в рублях:",
+        "commission": 0.123214261446109,
+        "payout": 0.97,
+        "modifier": {"key": "items", "title": "Предметы", "commission": 0.05576919826590123},
+        "currencies": ["uah", "brl", "usd"],
+    },
+    "telegram": {
+        "title": "🔵 Telegram",
+        "item": "товара",
+        "lot_prompt": "💸 Введите цену товара в рублях:",
+        "commission": 0.0,
+        "payout": 1.0,
+        "modifier": None,
+        "currencies": ["uah", "brl", "usd"],
+        "sum_on_comma": True,  # "100,50" в цене акции означает 100 + 50
+    },
+}
+
+class Game:
+    """Описание игры: комиссии, необязательный модификатор комиссии и валюты акций.
+
+    Итоговые множители выплаты (1 - комиссия) * выплата считаются один раз при загрузке.
+    """
+
+    __slots__ = (
+        "key", "title", "item", "lot_prompt", "currencies", "sum_on_comma",
+        "modifier_key", "modifier_title", "modes", "mode_factors",
+    )
+
+    def __init__(self, key: str, config: dict):
+        if not re.fullmatch(r"[a-z0-9]{1,16}", key):
+            raise ValueError(f"Некорректный ключ игры: {key}")
+        currencies = tuple(currency.lower() for currency in config.get("currencies", ("uah", "brl", "usd")))
+        if unknown := [currency for currency in currencies if currency.upper() not in CURRENCIES]:
+            raise ValueError(f"Неизвестные валюты игры {key}: {', '.join(unknown)}")
+        self.key = key
+        self.title = config["title"]
+        self.item = config.get("item", "лота")
+        self.lot_prompt = config.get("lot_prompt", f"💸 Введите цену {self.item} в рублях:")
+        self.currencies = currencies
+        self.sum_on_comma = bool(config.get("sum_on_comma", False))
+        payout = float(config.get("payout", 1.0))
+        modifier = config.get("modifier")
+        self.modes = (key,)
+        self.mode_factors = {key: (1 - float(config["commission"])) * payout}
+        self.modifier_key = self.modifier_title = None
+        if modifier:
+            self.modifier_key = modifier["key"]
+            self.modifier_title = modifier["title"]
+            self.modes = (key, f"{key}_{self.modifier_key}")
+            self.mode_factors[self.modes[1]] = (1 - float(modifier["commission"])) * payout
+
+    def mode(self, modifier_on: bool = False) -> str:
+        return self.modes[1] if modifier_on and self.modifier_key else self.modes[0]
+
+    def mode_title(self, mode: str) -> str:
+        return self.modifier_title.lower() if mode != self.key else "обычная"
+
+class GameRegistry:
+    """Реестр игр из файла конфигурации с перезагрузкой при изменении файла.
+
+    Файл читается при первом обращении к games, mode_factors или currencies.
+    """
+
+    def __init__(self, path: str, defaults: dict):
+        self.path = path
+        self.defaults = defaults
+        self._mtime = None
+        self._checked_at = 0.0
+        self._subscribers = []
+
+    def __getattr__(self, name):
+        # Вызывается, только пока реестр ещё не загружен
+        if name not in ("games", "mode_factors", "currencies"):
+            raise AttributeError(name)
+        self.load()
+        return self.__dict__[name]
+
+    def load(self):
+        try:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            self._mtime = None
+            config = self.defaults
+        except Exception as e:
+            print(f"Ошибка при загрузке игр: {e}")
+            if "games" in self.__dict__:
+                return
+            config = self.defaults
+        try:
+            games = {key: Game(key, game_config) for key, game_config in config.items()}
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Ошибка в описании игр: {e}")
+            if "games" in self.__dict__:
+                return
+            games = {key: Game(key, game_config) for key, game_config in self.defaults.items()}
+        mode_factors = {}
+        for game in games.values():
+            mode_factors.update(game.mode_factors)
+        currencies = tuple(dict.fromkeys(currency for game in games.values() for currency in game.currencies))
+        self.games, self.mode_factors, self.currencies = games, mode_factors, currencies
+        for callback in self._subscribers:
+            callback(self)
+
+    def refresh(self):
+        """Перечитывает файл, если он изменился (не чаще раза в GAMES_RELOAD_INTERVAL)."""
+        now = time.monotonic()
+        if now - self._checked_at < GAMES_RELOAD_INTERVAL and "games" in self.__dict__:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime or "games" not in self.__dict__:
+            self.load()
+
+    def subscribe(self, callback):
+        """Подписывает callback(registry) на перезагрузку реестра."""
+        self._subscribers.append(callback)
+
+    def get(self, key: str):
+        return self.games.get(key)
+
+    def __getitem__(self, key: str) -> Game:
+        return self.games[key]
+
+    def __iter__(self):
+        return iter(self.games.values())
+
+game_registry = GameRegistry(GAMES_FILE, DEFAULT_GAMES)
+
+# Денежная арифметика: суммы в целых копейках/центах, курсы и множители комиссий —
+# целые с масштабом FIXED_SCALE. Результат округляется до копейки один раз.
+EXACT_MONEY = True
+MINOR_SCALE = 100
+# 18 знаков: при 9 комиссия вида 0.05576919826590123 теряла разряды, и результат
+# у границы половины копейки уходил на копейку; целые Python большой масштаб не замедляет
+FIXED_SCALE = 10 ** 18
+_MINOR_QUANTUM = Decimal(1)
+
+def _finite_decimal(value) -> Decimal:
+    value = Decimal(value)
+    if not value.is_finite():
+        raise ValueError(f"Сумма должна быть конечным числом: {value}")
+    return value
+
+def to_minor(amount) -> int:
+    """Сумма в копейках/центах (округление половины вверх); inf и nan — ValueError."""
+    if isinstance(amount, float):
+        if not math.isfinite(amount):
+            raise ValueError(f"Сумма должна быть конечным числом: {amount}")
+        scaled = amount * MINOR_SCALE
+        minor = round(scaled)
+        # Decimal нужен только на границе половины копейки, где важна десятичная запись
+        if abs(abs(scaled - minor) - 0.5) > 1e-6:
+            return minor
+        amount = repr(amount)
+    return int((_finite_decimal(amount) * MINOR_SCALE).quantize(_MINOR_QUANTUM, ROUND_HALF_UP))
+
+def to_fixed(value) -> int:
+    """Курс или множитель как целое с масштабом FIXED_SCALE; inf и nan — ValueError."""
+    if isinstance(value, (Decimal, str)):
+        return int((_finite_decimal(value) * FIXED_SCALE).quantize(_MINOR_QUANTUM, ROUND_HALF_UP))
+    if not math.isfinite(value):
+        raise ValueError(f"Сумма должна быть конечным числом: {value}")
+    return round(value * FIXED_SCALE)
+
+def calculate_profits(lot_prices, action_prices, currencies, modes, rates=None):
+    """Рассчитывает себестоимость и чистую выгоду для пачки лотов за один проход.
+
+    Возвращает три списка: себестоимость в MDL, выгода в RUB и выгода в MDL.
+    При EXACT_MONEY значения точны до копейки/бани.
+    """
+    cross = exchange_rates.cross if rates is None else CrossRates(rates)
+    if EXACT_MONEY:
+        return _calculate_profits_exact(lot_prices, action_prices, currencies, modes, cross)
+    rub_rate = cross.rate(BASE_CURRENCY, "RUB")
+    # Множители валют берутся из матрицы кросс-курсов, множители режимов — из реестра игр
+    cost_factors = {currency: cross.rate(currency.upper(), BASE_CURRENCY) for currency in set(currencies)}
+    payout_factors = game_registry.mode_factors
+    mdl_prices, profits_rub, profits_mdl = [], [], []
+    for lot_price_buyer, action_price, currency, mode in zip(lot_prices, action_prices, currencies, modes):
+        mdl_price = action_price * cost_factors[currency]
+        net_profit = lot_price_buyer * payout_factors[mode] - mdl_price * rub_rate
+        mdl_prices.append(mdl_price)
+        profits_rub.append(net_profit)
+        profits_mdl.append(net_profit / rub_rate)
+    return mdl_prices, profits_rub, profits_mdl
+
+def _calculate_profits_exact(lot_prices, action_prices, currencies, modes, cross):
+    rub_rate = to_fixed(cross.rate(BASE_CURRENCY, "RUB"))
+    cost_factors = {
+        currency: (to_fixed(cross.rate(currency.upper(), BASE_CURRENCY)), to_fixed(cross.rate(currency.upper(), "RUB")))
+        for currency in set(currencies)
+    }
+    payout_factors = {mode: to_fixed(game_registry.mode_factors[mode]) for mode in set(modes)}
+    # Округление половины вверх: (2x + d) // 2d, удвоенные знаменатели считаются заранее
+    half_scale, double_scale, double_rub_rate = FIXED_SCALE, 2 * FIXED_SCALE, 2 * rub_rate
+    mdl_prices, profits_rub, profits_mdl = [], [], []
+    try:
+        for lot_price_buyer, action_price, currency, mode in zip(lot_prices, action_prices, currencies, modes):
+            # Быстрый путь to_minor прямо в цикле, граница половины копейки — через to_minor
+            scaled = lot_price_buyer * MINOR_SCALE
+            lot_minor = round(scaled)
+            if abs(abs(scaled - lot_minor) - 0.5) <= 1e-6:
+                lot_minor = to_minor(lot_price_buyer)
+            scaled = action_price * MINOR_SCALE
+            action_minor = round(scaled)
+            if abs(abs(scaled - action_minor) - 0.5) <= 1e-6:
+                action_minor = to_minor(action_price)
+            mdl_factor, rub_factor = cost_factors[currency]
+            # Выгода в копейках × FIXED_SCALE: без промежуточных округлений
+            net_profit = 2 * (lot_minor * payout_factors[mode] - action_minor * rub_factor)
+            # Копейки/бани делятся на 100 только для вывода: .2f даёт точное значение
+            mdl_prices.append((2 * action_minor * mdl_factor + half_scale) // double_scale / MINOR_SCALE)
+            profits_rub.append((net_profit + half_scale) // double_scale / MINOR_SCALE)
+            profits_mdl.append((net_profit + rub_rate) // double_rub_rate / MINOR_SCALE)
+    except OverflowError as e:
+        # round(inf) в быстром пути; round(nan) сам бросает ValueError
+        raise ValueError("Сумма должна быть конечным числом") from e
+    return mdl_prices, profits_rub, profits_mdl
+
+def calculate_profit(lot_price_buyer: float, action_price: float, currency: str, mode: str):
+    """Рассчитывает себестоимость (MDL) и чистую выгоду (RUB, MDL) для одного лота."""
+    mdl_prices, profits_rub, profits_mdl = calculate_profits((lot_price_buyer,), (action_price,), (currency,), (mode,))
+    return mdl_prices[0], profits_rub[0], profits_mdl[0]
+
+def calculate_min_lot_prices(action_prices, currencies, modes, margin: float = 0.0, rates=None):
+    """Обратная задача: минимальная цена лота для покупателя, при которой выгода
+    составляет долю margin от цены лота (margin=0 — безубыточность).
+
+    Из L * выплата - себестоимость = margin * L следует
+    L = себестоимость / (выплата - margin). Возвращает список цен в RUB
+    (None, если такая маржа недостижима при этой комиссии). При EXACT_MONEY
+    цена округляется вверх до копейки.
+    """
+    cross = exchange_rates.cross if rates is None else CrossRates(rates)
+    if EXACT_MONEY:
+        cost_factors = {currency: to_fixed(cross.rate(currency.upper(), "RUB")) for currency in set(currencies)}
+        divisors = {mode: to_fixed(game_registry.mode_factors[mode]) - to_fixed(margin) for mode in set(modes)}
+        return [
+            -(-to_minor(action_price) * cost_factors[currency] // divisors[mode]) / MINOR_SCALE if divisors[mode] > 0 else None
+            for action_price, currency, mode in zip(action_prices, currencies, modes)
+        ]
+    cost_factors = {currency: cross.rate(currency.upper(), "RUB") for currency in set(currencies)}
+    divisors = {mode: game_registry.mode_factors[mode] - margin for mode in set(modes)}
+    return [
+        action_price * cost_factors[currency] / divisors[mode] if divisors[mode] > 0 else None
+        for action_price, currency, mode in zip(action_prices, currencies, modes)
+    ]
+
+def render_scenario_matrix(game: Game, lot_price_buyer: float, action_prices: dict) -> str:
+    """Считает выгоду для всех валют и режимов комиссии игры одним пакетом и
+    собирает таблицу с выделенным лучшим вариантом.
+
+    action_prices — цены акции по валютам ({"uah": 100.0, ...}).
+    """
+    currencies, modes = [], []
+    for currency in action_prices:
+        for mode in game.modes:
+            currencies.append(currency)
+            modes.append(mode)
+    prices = [action_prices[currency] for currency in currencies]
+    mdl_prices, profits_rub, profits_mdl = calculate_profits([lot_price_buyer] * len(modes), prices, currencies, modes)
+    best = max(range(len(modes)), key=profits_rub.__getitem__)
+    header = f"  {'Вал.':<4} {'Акция':>8} {'Комиссия':<9} {'RUB':>9} {'MDL':>8}"
+    rows = [
+        f"{'>' if index == best else ' '} {currency.upper():<4} {price:>8.2f} {game.mode_title(mode):<9} {profit_rub:>9.2f} {profit_mdl:>8.2f}"
+        for index, (currency, price, mode, profit_rub, profit_mdl)
+        in enumerate(zip(currencies, prices, modes, profits_rub, profits_mdl))
+    ]
     return (
-        f"<b>💳 Актуальные курсы валют:</b>\n"
-        f"• 🇷🇺 <b>MDL - RUB:</b> <code>{exchange_rates['RUB']:.4f}</code> RUB\n"
-        f"• 🇺🇦 <b>UAH - MDL:</b> <code>{exchange_rates['UAH']:.4f}</code> MDL\n"
-        f"• 🇧🇷 <b>BRL - MDL:</b> <code>{exchange_rates['BRL']:.4f}</code> MDL\n"  # Добавлены реалы
-        f"• 🇺🇸 <b>USD - MDL:</b> <code>{exchange_rates['USD']:.2f}</code> MDL\n\n"
-        f"⚙️ Выберите функцию:"
+        f"🇷🇺 Цена лота: <code>{lot_price_buyer:.2f}</code> RUB\n"
+        f"<pre>{header}\n" + "\n".join(rows) + "</pre>\n"
+        f"<b>⭐ Лучший вариант:</b> {currencies[best].upper()}, комиссия «{game.mode_title(modes[best])}» — "
+        f"<code>{profits_rub[best]:.2f}</code> RUB (~<code>{profits_mdl[best]:.2f}</code> MDL)"
     )
 
-def main(cardinal: Cardinal, *args):
-    if not cardinal.telegram:
-        return
-    tg = cardinal.telegram
-    bot = tg.bot
+# Маржа по умолчанию для /rate_solve, доля от цены лота
+TARGET_MARGIN = 0.10
 
-    def start_rate(message: Message, edit_message_id: int = None):
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            InlineKeyboardButton("💳 Обновить курсы", callback_data="update_rates"),
-            InlineKeyboardButton("💰 Рассчитать выгоду", callback_data="calculate_profit")
-        )
-        if edit_message_id:
-            bot.edit_message_text(generate_main_message(), message.chat.id, edit_message_id, reply_markup=markup, parse_mode="HTML")
+def render_min_lot_prices(action_price: float, margin: float) -> str:
+    """Таблица безубыточной и целевой цены лота для всех валют и режимов комиссии."""
+    currencies = [currency for currency in game_registry.currencies for _ in game_registry.mode_factors]
+    modes = list(game_registry.mode_factors) * len(game_registry.currencies)
+    break_even = calculate_min_lot_prices([action_price] * len(modes), currencies, modes)
+    target = calculate_min_lot_prices([action_price] * len(modes), currencies, modes, margin)
+    header = f"{'Вал.':<4} {'Режим':<12} {'Безуб.':>9} {f'{margin:.0%}':>9}"
+    rows = [
+        f"{currency.upper():<4} {mode:<12} {low:>9.2f} " + (f"{high:>9.2f}" if high is not None else f"{'—':>9}")
+        for currency, mode, low, high in zip(currencies, modes, break_even, target)
+    ]
+    return (
+        f"<b>🎯 Минимальная цена лота при цене акции</b> <code>{action_price:.2f}</code>:\n"
+        f"<pre>{header}\n" + "\n".join(rows) + "</pre>"
+    )
+
+# Безопасный калькулятор цены акции: только числа, + - * / и скобки
+MAX_EXPRESSION_LENGTH = 200
+MAX_EXPRESSION_NODES = 100
+EXPRESSION_TOKEN = re.compile(r"\s*(?:(\d+(?:\.\d*)?|\.\d+)|(\S))")
+
+class ExpressionError(ValueError):
+    """Некорректное или слишком сложное выражение цены."""
+
+def _tokenize_expression(text: str):
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = EXPRESSION_TOKEN.match(text, position)
+        number, operator = match.groups()
+        if number is not None:
+            yield Decimal(number)
+        elif operator in "+-*/()":
+            yield operator
         else:
-            bot.send_message(message.chat.id, generate_main_message(), reply_markup=markup, parse_mode="HTML")
-
-    def handle_callback(call):
-        user_id = call.from_user.id
-        last_requests.pop(user_id, None)  # Сброс предыдущих запросов
-        if call.data == "update_rates":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(
-                InlineKeyboardButton("🇷🇺 MDL - RUB", callback_data="update_rub"),
-                InlineKeyboardButton("🇺🇦 UAH - MDL", callback_data="update_uah"),
-                InlineKeyboardButton("🇧🇷 BRL - MDL", callback_data="update_brl"),  # Добавлены реалы
-                InlineKeyboardButton("🇺🇲 USD - MDL", callback_data="update_usd"),
-                InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")
-            )
-            bot.edit_message_text(
-                "⚙️ Выберите обновляемый курс:",
-                call.message.chat.id,
-                call.message.id,
-                reply_markup=markup
-            )
-        elif call.data.startswith("update_"):
-            currency = call.data.split("_")[1]
-            if currency == "rub":
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.edit_message_text(
-                    "🟢 По какому курсу куплены USDT?",
-                    call.message.chat.id,
-                    call.message.id,
-                    reply_markup=markup
-                )
-                last_requests[user_id] = "update_rub"
-                bot.register_next_step_handler(call.message, lambda msg: update_rub_rate(msg, call.message.id))
-            elif currency == "uah":
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.edit_message_text(
-                    "🇲🇩 Какая сумма последней транзакции в леях?",
-                    call.message.chat.id,
-                    call.message.id,
-                    reply_markup=markup
-                )
-                last_requests[user_id] = "update_uah"
-                bot.register_next_step_handler(call.message, lambda msg: update_uah_rate(msg, call.message.id))
-            elif currency == "brl":  # Добавлено обновление курса BRL
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.edit_message_text(
-                    "🇲🇩 Какая сумма последней транзакции в леях?",
-                    call.message.chat.id,
-                    call.message.id,
-                    reply_markup=markup
-                )
-                last_requests[user_id] = "update_brl"
-                bot.register_next_step_handler(call.message, lambda msg: update_brl_rate(msg, call.message.id))
-            elif currency == "usd":
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.edit_message_text(
-                    "🇺🇲 Какой курс <b>USD - MDL</b>?",
-                    call.message.chat.id,
-                    call.message.id,
-                    parse_mode="HTML",
-                    reply_markup=markup
-                )
-                last_requests[user_id] = "update_usd"
-                bot.register_next_step_handler(call.message, lambda msg: update_usd_rate(msg, call.message.id))
-
-        elif call.data == "calculate_profit":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(
-                InlineKeyboardButton("🟡 Brawl Stars", callback_data="brawl_stars"),
-                InlineKeyboardButton("🔴 Clash Royale", callback_data="clash_royale"),
-                InlineKeyboardButton("🔵 Telegram", callback_data="telegram"),
-                InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")
-            )
-        
-            # Проверяем, откуда нажата кнопка
-            if call.message.text and "💰 Чистая выгода" in call.message.text:
-                # Если кнопка нажата после расчёта (чистая выгода уже была показана)
-                bot.send_message(call.message.chat.id, "🎮 Выберите категорию:", reply_markup=markup)
+            raise ExpressionError(f"Недопустимый символ: {operator}")
+        position = match.end()
+
+@functools.lru_cache(maxsize=512)
+def compile_expression(text: str):
+    """Разбирает выражение в обратную польскую запись (кэшируется)."""
+    if len(text) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError("Слишком длинное выражение")
+    tokens = list(_tokenize_expression(text))
+    if len(tokens) > MAX_EXPRESSION_NODES:
+        raise ExpressionError("Слишком сложное выражение")
+    output = []
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_sum():
+        nonlocal position
+        parse_product()
+        while peek() in ("+", "-"):
+            operator = tokens[position]
+            position += 1
+            parse_product()
+            output.append(operator)
+
+    def parse_product():
+        nonlocal position
+        parse_factor()
+        while peek() in ("*", "/"):
+            operator = tokens[position]
+            position += 1
+            parse_factor()
+            output.append(operator)
+
+    def parse_factor():
+        nonlocal position
+        token = peek()
+        position += 1
+        if isinstance(token, Decimal):
+            output.append(token)
+        elif token in ("+", "-"):
+            parse_factor()
+            if token == "-":
+                output.append("neg")
+        elif token == "(":
+            parse_sum()
+            if peek() != ")":
+                raise ExpressionError("Не закрыта скобка")
+            position += 1
+        else:
+            raise ExpressionError("Ожидалось число")
+
+    parse_sum()
+    if position != len(tokens):
+        raise ExpressionError("Лишние символы в выражении")
+    return tuple(output)
+
+def evaluate_expression(text: str) -> Decimal:
+    """Вычисляет арифметическое выражение точно, в Decimal."""
+    stack = []
+    for token in compile_expression(text.strip()):
+        if isinstance(token, Decimal):
+            stack.append(token)
+        elif token == "neg":
+            stack.append(-stack.pop())
+        else:
+            right = stack.pop()
+            left = stack.pop()
+            if token == "+":
+                stack.append(left + right)
+            elif token == "-":
+                stack.append(left - right)
+            elif token == "*":
+                stack.append(left * right)
+            elif right == 0:
+                raise ExpressionError("Деление на ноль")
             else:
-                # Если кнопка нажата из главного меню, редактируем сообщение
-                bot.edit_message_text("🎮 Выберите категорию:", call.message.chat.id, call.message.id, reply_markup=markup)
-        
-            bot.answer_callback_query(call.id)
-
-        elif call.data == "brawl_stars":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
-            bot.edit_message_text(
-                "💸 Введите цену лота (для покупателя) в рублях:",
-                call.message.chat.id,
-                call.message.id,
-                reply_markup=markup
-            )
-            last_requests[user_id] = "brawl_stars"
-            bot.register_next_step_handler(call.message, lambda msg: get_brawl_stars_lot_price(msg, call.message.id))
-
-        elif call.data == "clash_royale":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
-            bot.edit_message_text(
-                "💸 Введите цену лота (для покупателя) в рублях:",
-                call.message.chat.id,
-                call.message.id,
-                reply_markup=markup
-            )
-            last_requests[user_id] = "clash_royale"
-            bot.register_next_step_handler(call.message, lambda msg: get_clash_royale_lot_price(msg, call.message.id))
-
-        elif call.data == "telegram":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
-            bot.edit_message_text(
-                "💸 Введите цену товара в рублях:",
-                call.message.chat.id,
-                call.message.id,
-                reply_markup=markup
-            )
-            last_requests[user_id] = "telegram"
-            bot.register_next_step_handler(call.message, lambda msg: get_telegram_lot_price(msg, call.message.id))
-
-        elif call.data == "back_to_main":
-            start_rate(call.message, call.message.id)
-        elif call.data == "back_to_update_rates":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(
-                InlineKeyboardButton("🇷🇺 MDL - RUB", callback_data="update_rub"),
-                InlineKeyboardButton("🇺🇦 UAH - MDL", callback_data="update_uah"),
-                InlineKeyboardButton("🇧🇷 BRL - MDL", callback_data="update_brl"),  # Добавлены реалы
-                InlineKeyboardButton("🇺🇲 USD - MDL", callback_data="update_usd"),
-                InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")
-            )
-            bot.edit_message_text(
-                "⚙️ Выберите обновляемый курс:",
-                call.message.chat.id,
-                call.message.id,
-                reply_markup=markup
-            )
-        elif call.data == "back_to_game_selection":
-            markup = InlineKeyboardMarkup(row_width=1)
-            markup.add(
-                InlineKeyboardButton("🟡 Brawl Stars", callback_data="brawl_stars"),
-                InlineKeyboardButton("🔴 Clash Royale", callback_data="clash_royale"),
-                InlineKeyboardButton("🔵 Telegram", callback_data="telegram"),
-                InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")
+                stack.append(left / right)
+    return stack[0]
+
+_MISSING = object()
+
+class _SessionEntry:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value, expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+
+class SessionStore:
+    """Ограниченное хранилище сессий с TTL и вытеснением давно неиспользуемых записей.
+
+    Поддерживает словарный интерфейс (get, pop, [], in, len).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= now:
+                if entry is not None:
+                    del self._entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = _SessionEntry(value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None or entry.expires_at <= time.monotonic():
+            return default
+        return entry.value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Счётчики попаданий, промахов и вытеснений."""
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# Состояния переключателей комиссии
+SESSION_TTL = 6 * 60 * 60
+alternate_commission_states = SessionStore(max_size=10_000, ttl=SESSION_TTL)
+
+# Состояние диалогов: (чат, пользователь) -> (шаг, данные), хранится в SQLite (WAL)
+CONVERSATIONS_FILE = "rate_calculator_conversations.sqlite3"
+CONVERSATION_TTL = SESSION_TTL
+CONVERSATION_PURGE_INTERVAL = 600.0
+
+class ConversationStore:
+    """Состояния диалогов на диске: переживают перезапуск Cardinal и устаревают через ttl.
+
+    Все живые состояния держатся и в памяти, поэтому чтение — один поиск в
+    словаре; каждое изменение сразу записывается в базу.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+        self._states = {}
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def open(self):
+        """Открывает базу и восстанавливает незавершённые диалоги."""
+        with self._lock:
+            self._connect()
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, state TEXT NOT NULL, "
+                "data TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID"
             )
-            bot.edit_message_text(
-                "🎮 Выберите категорию:",
-                call.message.chat.id,
-                call.message.id,
-                reply_markup=markup
+            now = time.time()
+            db.execute("DELETE FROM conversations WHERE expires_at <= ?", (now,))
+            self._states = {
+                (chat_id, user_id): (state, json.loads(data), expires_at)
+                for chat_id, user_id, state, data, expires_at in db.execute("SELECT * FROM conversations")
+            }
+            self._purged_at = now
+            self._db = db
+        return self._db
+
+    def get(self, chat_id: int, user_id: int):
+        """Возвращает (шаг, данные) или None."""
+        if self._db is None:
+            with self._lock:
+                self._connect()
+        entry = self._states.get((chat_id, user_id))
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    def set(self, chat_id: int, user_id: int, state: str, data: dict):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)",
+                (chat_id, user_id, state, json.dumps(data), now + self.ttl)
             )
+            self._states[chat_id, user_id] = (state, data, now + self.ttl)
+            if now - self._purged_at > CONVERSATION_PURGE_INTERVAL:
+                self._purge(db, now)
 
-    def update_rub_rate(message: Message, edit_message_id: int):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "update_rub":
-            try:
-                buy_rate = float(message.text)
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.send_message(message.chat.id, "🔴 По какому курсу проданы USDT?", reply_markup=markup)
-                last_requests[user_id] = "finalize_rub"
-                bot.register_next_step_handler(message, lambda msg: finalize_update_rub_rate(msg, buy_rate))
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректный курс покупки USDT.")
-                bot.register_next_step_handler(message, lambda msg: update_rub_rate(msg, edit_message_id))
-
-    def finalize_update_rub_rate(message: Message, buy_rate: float):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "finalize_rub":
-            try:
-                sell_rate = float(message.text)
-                exchange_rates["RUB"] = buy_rate / sell_rate
-                save_exchange_rates()  # Сохраняем обновленные курсы
-                bot.send_message(message.chat.id, "✅ Курс <b>🇷🇺 MDL - RUB</b> успешно обновлён!", parse_mode="HTML")
-                start_rate(message)
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректный курс продажи USDT.")
-                bot.register_next_step_handler(message, lambda msg: finalize_update_rub_rate(msg, buy_rate))
-
-    def update_uah_rate(message: Message, edit_message_id: int):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "update_uah":
-            try:
-                mdl_amount = float(message.text)
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.send_message(message.chat.id, "🇺🇦 Какая сумма этой транзакции в гривнах?", reply_markup=markup)
-                last_requests[user_id] = "finalize_uah"
-                bot.register_next_step_handler(message, lambda msg: finalize_update_uah_rate(msg, mdl_amount))
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную сумму в леях.")
-                bot.register_next_step_handler(message, lambda msg: update_uah_rate(msg, edit_message_id))
-
-    def finalize_update_uah_rate(message: Message, mdl_amount: float):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "finalize_uah":
-            try:
-                uah_amount = float(message.text)
-                exchange_rates["UAH"] = mdl_amount / uah_amount
-                save_exchange_rates()  # Сохраняем обновленные курсы
-                bot.send_message(message.chat.id, "✅ Курс <b>🇺🇦 UAH - MDL</b> успешно обновлён!", parse_mode="HTML")
-                start_rate(message)
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную сумму в гривнах.")
-                bot.register_next_step_handler(message, lambda msg: finalize_update_uah_rate(msg, mdl_amount))
-
-    def update_brl_rate(message: Message, edit_message_id: int):  # Добавлена функция для BRL
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "update_brl":
-            try:
-                mdl_amount = float(message.text)
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_update_rates"))
-                bot.send_message(message.chat.id, "🇧🇷 Какая сумма этой транзакции в реалах?", reply_markup=markup)
-                last_requests[user_id] = "finalize_brl"
-                bot.register_next_step_handler(message, lambda msg: finalize_update_brl_rate(msg, mdl_amount))
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную сумму в леях.")
-                bot.register_next_step_handler(message, lambda msg: update_brl_rate(msg, edit_message_id))
-
-    def finalize_update_brl_rate(message: Message, mdl_amount: float):  # Добавлена функция для BRL
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "finalize_brl":
-            try:
-                brl_amount = float(message.text)
-                exchange_rates["BRL"] = mdl_amount / brl_amount
-                save_exchange_rates()  # Сохраняем обновленные курсы
-                bot.send_message(message.chat.id, "✅ Курс <b>🇧🇷 BRL - MDL</b> успешно обновлён!", parse_mode="HTML")
-                start_rate(message)
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную сумму в реалах.")
-                bot.register_next_step_handler(message, lambda msg: finalize_update_brl_rate(msg, mdl_amount))
-
-    def update_usd_rate(message: Message, edit_message_id: int):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "update_usd":
-            try:
-                exchange_rates["USD"] = float(message.text)
-                save_exchange_rates()  # Сохраняем обновленные курсы
-                bot.send_message(message.chat.id, "✅ Курс <b>🇺🇲 USD - MDL</b> успешно обновлён!", parse_mode="HTML")
-                start_rate(message)
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректный курс USD - MDL.")
-                bot.register_next_step_handler(message, lambda msg: update_usd_rate(msg, edit_message_id))
-
-    def get_brawl_stars_lot_price(message: Message, edit_message_id: int):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "brawl_stars":
-            try:
-                lot_price_buyer = float(message.text)
-                lot_price = lot_price_buyer * (1 - 0.16068374059755964)  # Вычитаем 16.068374059755964%
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton("🇺🇦 Гривны", callback_data=f"brawl_profit_uah_{lot_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🇧🇷 Реалы", callback_data=f"brawl_profit_brl_{lot_price}_{lot_price_buyer}"),  # Добавлены реалы
-                    InlineKeyboardButton("🇺🇲 Доллары", callback_data=f"brawl_profit_usd_{lot_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection")
-                )
-                bot.send_message(message.chat.id, "⚙️ Выберите валюту акции:", reply_markup=markup)
-                last_requests[user_id] = f"brawl_select_currency_{lot_price}_{lot_price_buyer}"
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную цену лота.")
-                bot.register_next_step_handler(message, lambda msg: get_brawl_stars_lot_price(msg, edit_message_id))
-
-    def get_clash_royale_lot_price(message: Message, edit_message_id: int):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "clash_royale":
-            try:
-                lot_price_buyer = float(message.text)
-                lot_price = lot_price_buyer * (1 - 0.123214261446109)  # Вычитаем 12.3214261446109%
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton("🇺🇦 Гривны", callback_data=f"clash_profit_uah_{lot_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🇧🇷 Реалы", callback_data=f"clash_profit_brl_{lot_price}_{lot_price_buyer}"),  # Добавлены реалы
-                    InlineKeyboardButton("🇺🇲 Доллары", callback_data=f"clash_profit_usd_{lot_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection")
+    def delete(self, chat_id: int, user_id: int):
+        with self._lock:
+            db = self._connect()
+            if self._states.pop((chat_id, user_id), None) is not None:
+                db.execute("DELETE FROM conversations WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+    def _purge(self, db, now: float):
+        self._purged_at = now
+        db.execute("DELETE FROM conversations WHERE expires_at <= ?", (now,))
+        self._states = {key: entry for key, entry in self._states.items() if entry[2] > now}
+
+    def __len__(self):
+        with self._lock:
+            self._connect()
+            return len(self._states)
+
+    def close(self, *args):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class ConversationRouter:
+    """Конечный автомат диалогов: шаг диалога (чат, пользователь) -> обработчик.
+
+    Обработчик вызывается как handler(message, data) и сам переводит диалог на
+    следующий шаг (begin) или завершает его (end). При ошибке ввода шаг
+    остаётся прежним. Время каждого шага попадает в "conversation.<шаг>".
+    """
+
+    def __init__(self, store: ConversationStore):
+        self.store = store
+        self._handlers = {}
+
+    def on(self, state: str, handler):
+        self._handlers[state] = (handler, metrics.histogram(f"conversation.{state}"))
+
+    def begin(self, chat_id: int, user_id: int, state: str, **data):
+        self.store.set(chat_id, user_id, state, data)
+
+    def end(self, chat_id: int, user_id: int):
+        self.store.delete(chat_id, user_id)
+
+    def matches(self, message) -> bool:
+        # Команды обрабатываются своими обработчиками, даже посреди диалога
+        if message.text and message.text.startswith("/"):
+            return False
+        entry = self.store.get(message.chat.id, message.from_user.id)
+        return entry is not None and entry[0] in self._handlers
+
+    def dispatch(self, message):
+        entry = self.store.get(message.chat.id, message.from_user.id)
+        if entry is None or entry[0] not in self._handlers:
+            return
+        handler, histogram = self._handlers[entry[0]]
+        start = time.perf_counter()
+        try:
+            handler(message, entry[1])
+        finally:
+            histogram.record(time.perf_counter() - start)
+
+conversation_store = ConversationStore(CONVERSATIONS_FILE, CONVERSATION_TTL)
+conversations = ConversationRouter(conversation_store)
+
+# Журнал расчётов: каждая посчитанная выгода попадает в SQLite
+LEDGER_FILE = "rate_calculator_ledger.sqlite3"
+# Пауза (в секундах), за которую расчёты копятся в одну транзакцию
+LEDGER_FLUSH_INTERVAL = 2.0
+WEEK_OFFSET = 3 * 86400  # 1 января 1970 года — четверг, недели считаются с понедельника
+
+class ProfitLedger:
+    """Журнал расчётов выгоды в SQLite.
+
+    record() только кладёт строку в очередь; фоновый поток раз в flush_interval
+    пишет накопленное одной транзакцией и тут же обновляет суточные и недельные
+    свёртки, поэтому /rate_report читает десятки строк, а не весь журнал.
+    """
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = None
+        self._queue = deque()
+        self._pending = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(
+                "CREATE TABLE IF NOT EXISTS quotes ("
+                "id INTEGER PRIMARY KEY, ts REAL NOT NULL, game TEXT NOT NULL, mode TEXT NOT NULL, "
+                "currency TEXT NOT NULL, lot_price REAL NOT NULL, action_price REAL NOT NULL, "
+                "rub_rate REAL NOT NULL, currency_rate REAL NOT NULL, net_rub REAL NOT NULL, net_mdl REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS quotes_ts ON quotes (ts);"
+                "CREATE INDEX IF NOT EXISTS quotes_game_ts ON quotes (game, ts);"
+                "CREATE INDEX IF NOT EXISTS quotes_currency_ts ON quotes (currency, ts);"
+                + "".join(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    "period INTEGER NOT NULL, game TEXT NOT NULL, mode TEXT NOT NULL, currency TEXT NOT NULL, "
+                    "quotes INTEGER NOT NULL, losses INTEGER NOT NULL, lot_total REAL NOT NULL, "
+                    "net_rub REAL NOT NULL, net_mdl REAL NOT NULL, "
+                    "PRIMARY KEY (period, game, mode, currency)) WITHOUT ROWID;"
+                    for table in ("daily", "weekly")
                 )
-                bot.send_message(message.chat.id, "⚙️ Выберите валюту акции:", reply_markup=markup)
-                last_requests[user_id] = f"clash_select_currency_{lot_price}_{lot_price_buyer}"
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную цену лота.")
-                bot.register_next_step_handler(message, lambda msg: get_clash_royale_lot_price(msg, edit_message_id))
-
-    def get_telegram_lot_price(message: Message, edit_message_id: int):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == "telegram":
+            )
+            self._db = db
+        return self._db
+
+    def record(self, game: str, mode: str, currency: str, lot_price: float, action_price: float,
+               net_rub: float, net_mdl: float, rates=None):
+        """Ставит расчёт в очередь на запись; курсы берутся текущие, если не переданы."""
+        rates = exchange_rates if rates is None else rates
+        self._queue.append((
+            time.time(), game, mode, currency.upper(), lot_price, action_price,
+            rates["RUB"], rates[currency.upper()], net_rub, net_mdl
+        ))
+        self._pending.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="rate-calculator-ledger", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Немедленно записывает накопленные расчёты и обновляет свёртки."""
+        with self._lock:
+            self._pending.clear()
+            # deque потокобезопасна: record() не ждёт, пока идёт запись
+            batch = [self._queue.popleft() for _ in range(len(self._queue))]
+            if not batch:
+                return
+            start = time.perf_counter()
+            rollups = {"daily": {}, "weekly": {}}
+            for ts, game, mode, currency, lot_price, _, _, _, net_rub, net_mdl in batch:
+                day = int(ts // 86400 * 86400)
+                week = int((ts + WEEK_OFFSET) // 604800 * 604800 - WEEK_OFFSET)
+                for table, period in (("daily", day), ("weekly", week)):
+                    row = rollups[table].setdefault((period, game, mode, currency), [0, 0, 0.0, 0.0, 0.0])
+                    row[0] += 1
+                    row[1] += net_rub < 0
+                    row[2] += lot_price
+                    row[3] += net_rub
+                    row[4] += net_mdl
             try:
-                lot_price_buyer = float(message.text)
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton("🇺🇦 Гривны", callback_data=f"telegram_profit_uah_{lot_price_buyer}"),
-                    InlineKeyboardButton("🇧🇷 Реалы", callback_data=f"telegram_profit_brl_{lot_price_buyer}"),  # Добавлены реалы
-                    InlineKeyboardButton("🇺🇲 Доллары", callback_data=f"telegram_profit_usd_{lot_price_buyer}"),
-                    InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection")
-                )
-                bot.send_message(message.chat.id, "⚙️ Выберите валюту акции:", reply_markup=markup)
-                last_requests[user_id] = f"telegram_select_currency_{lot_price_buyer}"
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную цену товара.")
-                bot.register_next_step_handler(message, lambda msg: get_telegram_lot_price(msg, edit_message_id))
-
-    def handle_brawl_stars_currency(call):
-        user_id = call.from_user.id
-        data = call.data.split("_")
-        currency = data[2]
-        lot_price = float(data[3])
-        lot_price_buyer = float(data[4])
-    
+                db = self._connect()
+                with db:
+                    db.execute("BEGIN")
+                    db.executemany("INSERT INTO quotes VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                    for table, rows in rollups.items():
+                        db.executemany(
+                            f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (period, game, mode, currency) DO UPDATE SET "
+                            "quotes = quotes + excluded.quotes, losses = losses + excluded.losses, "
+                            "lot_total = lot_total + excluded.lot_total, "
+                            "net_rub = net_rub + excluded.net_rub, net_mdl = net_mdl + excluded.net_mdl",
+                            [(*key, *values) for key, values in rows.items()]
+                        )
+                metrics.increment("ledger.quotes", len(batch))
+            except Exception as e:
+                # Транзакция откатилась: пачка возвращается в начало очереди в прежнем порядке
+                self._queue.extendleft(reversed(batch))
+                self._pending.set()
+                metrics.increment("ledger.write.errors")
+                print(f"Ошибка при записи журнала расчётов: {e}")
+            finally:
+                metrics.observe("ledger.write", time.perf_counter() - start)
+
+    def report(self, table: str, since: float, by_game: bool = False):
+        """Свёртка за периоды с since: [(начало периода, [игра,] расчётов, убыточных, сумма лотов, RUB, MDL)]."""
+        self.flush()
+        group = "period, game" if by_game else "period"
+        with self._lock:
+            db = self._connect()
+            return db.execute(
+                f"SELECT {group}, SUM(quotes), SUM(losses), SUM(lot_total), SUM(net_rub), SUM(net_mdl) "
+                f"FROM {table} WHERE period >= ? GROUP BY {group} ORDER BY {group}",
+                (int(since),)
+            ).fetchall()
+
+    def close(self, *args):
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+profit_ledger = ProfitLedger(LEDGER_FILE, LEDGER_FLUSH_INTERVAL)
+atexit.register(profit_ledger.flush)
+
+def render_profit_report(days: int = 7, weeks: int = 4) -> str:
+    """Сводка журнала для /rate_report: по дням и по неделям в разрезе игр."""
+    now = time.time()
+    today = now - now % 86400
+    this_week = (now + WEEK_OFFSET) // 604800 * 604800 - WEEK_OFFSET
+    header = f"{'':<5} {'N':>5} {'Убыт.':>5} {'Выгода RUB':>11} {'Маржа':>6}"
+
+    def row(label, quotes, losses, lot_total, net_rub):
+        margin = f"{net_rub / lot_total * 100:>5.1f}%" if lot_total else f"{'—':>6}"
+        return f"{label:<5} {quotes:>5} {losses:>5} {net_rub:>11.2f} {margin}"
+
+    daily = [
+        row(time.strftime("%d.%m", time.gmtime(day)), quotes, losses, lot_total, net_rub)
+        for day, quotes, losses, lot_total, net_rub, _ in profit_ledger.report("daily", today - (days - 1) * 86400)
+    ]
+    weekly = [
+        row(time.strftime("%d.%m", time.gmtime(week)), quotes, losses, lot_total, net_rub) + f" {html.escape(game)}"
+        for week, game, quotes, losses, lot_total, net_rub, _
+        in profit_ledger.report("weekly", this_week - (weeks - 1) * 604800, by_game=True)
+    ]
+    return (
+        f"<b>📒 Расчёты за {days} дн.:</b>\n<pre>{header}\n" + ("\n".join(daily) or "нет данных") + "</pre>\n"
+        f"<b>📒 По неделям и играм:</b>\n<pre>{header}\n" + ("\n".join(weekly) or "нет данных") + "</pre>"
+    )
+
+# Компактный формат callback_data: "<опкод>:<игра>:<base64(struct)>", не больше 64 байт.
+# Опкоды начинаются с префикса плагина, чтобы не перехватывать кнопки Cardinal и других плагинов
+CALLBACK_PREFIX = "rate_"
+CALLBACK_OPCODES = {
+    verb: CALLBACK_PREFIX + opcode
+    for verb, opcode in {
+        "select_game": "gs",
+        "select_currency": "sc",
+        "toggle_modifier": "tm",
+        "recalculate": "rl",
+        "compare": "cm",
+        "bulk_page": "pg",
+    }.items()
+}
+CALLBACK_CURRENCIES = tuple(code.lower() for code in CURRENCIES)
+
+def encode_callback(verb: str, game: str | None, currency: str | None, *values: float) -> str:
+    """Упаковывает глагол, игру, валюту и числа в короткую строку callback_data."""
+    currency_index = 255 if currency is None else CALLBACK_CURRENCIES.index(currency)
+    packed = struct.pack(f"<B{len(values)}d", currency_index, *values)
+    return f"{CALLBACK_OPCODES[verb]}:{game or ''}:{base64.urlsafe_b64encode(packed).rstrip(b'=').decode()}"
+
+def decode_callback(data: str):
+    """Распаковывает callback_data: возвращает (игра, валюта, (числа...))."""
+    try:
+        _, game, payload = data.split(":", 2)
+        payload = base64.urlsafe_b64decode(payload + "==")
+        values = struct.unpack(f"<B{(len(payload) - 1) // 8}d", payload)
+    except (ValueError, struct.error) as e:
+        raise ValueError(f"Некорректные данные кнопки: {data}") from e
+    currency_index, values = values[0], values[1:]
+    if (currency_index != 255 and currency_index >= len(CALLBACK_CURRENCIES)) or not all(map(math.isfinite, values)):
+        raise ValueError(f"Некорректные данные кнопки: {data}")
+    return game or None, (None if currency_index == 255 else CALLBACK_CURRENCIES[currency_index]), values
+
+class CallbackRouter:
+    """Маршрутизатор callback-кнопок: глагол кнопки -> обработчик за один поиск в словаре.
+
+    Точные маршруты сравниваются с callback_data целиком, префиксные — по опкоду
+    из encode_callback ("rate_tm:..." -> "toggle_modifier"). Время обработки каждого
+    маршрута попадает в гистограмму metrics "callback.<маршрут>". На повреждённые
+    кнопки (ValueError в обработчике) router отвечает через bot, заданный в main().
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefix = {}
+        self.bot = None
+
+    def add(self, data: str, handler, reset_request: bool = False):
+        self._exact[data] = (data, handler, reset_request, metrics.histogram(f"callback.{data}"))
+
+    def add_prefix(self, verb: str, handler, reset_request: bool = False):
+        self._prefix[CALLBACK_OPCODES[verb]] = (verb, handler, reset_request, metrics.histogram(f"callback.{verb}"))
+
+    def resolve(self, data: str):
+        route = self._exact.get(data)
+        if route is None:
+            route = self._prefix.get(data.partition(":")[0])
+        return route
+
+    def matches(self, call) -> bool:
+        return bool(call.data) and self.resolve(call.data) is not None
+
+    def dispatch(self, call):
+        _, handler, reset_request, histogram = self.resolve(call.data)
+        if reset_request:
+            conversations.end(call.message.chat.id, call.from_user.id)  # Сброс начатого диалога
+        start = time.perf_counter()
+        try:
+            handler(call)
+        except ValueError as e:
+            # Без ответа у пользователя бесконечно крутятся «часики» на кнопке
+            print(f"Некорректная кнопка {call.data!r}: {e}")
+            self.bot.answer_callback_query(call.id, "❌ Кнопка устарела, откройте меню заново.")
+        finally:
+            histogram.record(time.perf_counter() - start)
+
+    def stats(self):
+        """Возвращает {маршрут: (вызовов, среднее время, максимум)} по убыванию частоты."""
+        routes = [(name, histogram) for name, _, _, histogram in (*self._exact.values(), *self._prefix.values())]
+        return {
+            name: (histogram.count, histogram.total / histogram.count if histogram.count else 0.0, histogram.peak)
+            for name, histogram in sorted(routes, key=lambda item: -item[1].count)
+        }
+
+callback_router = CallbackRouter()
+
+# Пакетный расчёт: строки вида "игра;цена_лота;валюта;цена_акции"
+BULK_PAGE_SIZE = 20
+BULK_MAX_ERRORS = 10
+BULK_FIELD_PREVIEW = 24  # столько символов поля ввода цитируется в сообщении об ошибке
+# Таблицы по (пользователь, номер таблицы): кнопки старого результата листают свою таблицу
+bulk_tables = SessionStore(max_size=1_000, ttl=SESSION_TTL)
+bulk_table_ids = itertools.count(1)
+
+def _bulk_field(text: str) -> str:
+    return text if len(text) <= BULK_FIELD_PREVIEW else text[:BULK_FIELD_PREVIEW - 1] + "…"
+
+def parse_bulk_lots(lines):
+    """Разбирает строки пакетного ввода за один проход.
+
+    Возвращает столбцы (игры, цены лотов, валюты, цены акций) и список ошибок.
+    """
+    games, lot_prices, currencies, action_prices, errors = [], [], [], [], []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [part.strip() for part in line.split(";")]
+        if len(parts) != 4:
+            errors.append(f"{line_number}: ожидается 4 поля через «;»")
+            continue
+        game, lot_price, currency, action_price = parts[0].lower(), parts[1], parts[2].lower(), parts[3]
+        if game not in game_registry.mode_factors:
+            errors.append(f"{line_number}: неизвестная игра «{_bulk_field(parts[0])}»")
+            continue
+        if currency not in game_registry.currencies:
+            errors.append(f"{line_number}: неизвестная валюта «{_bulk_field(parts[2])}»")
+            continue
+        try:
+            lot_price, action_price = parse_number(lot_price.replace(",", ".")), parse_number(action_price.replace(",", "."))
+        except ValueError:
+            errors.append(f"{line_number}: некорректная цена")
+            continue
+        games.append(game)
+        lot_prices.append(lot_price)
+        currencies.append(currency)
+        action_prices.append(action_price)
+    return games, lot_prices, currencies, action_prices, errors
+
+def render_bulk_pages(games, lot_prices, currencies, action_prices, errors):
+    """Считает выгоду для всех лотов разом и разбивает таблицу на страницы."""
+    _, profits_rub, profits_mdl = calculate_profits(lot_prices, action_prices, currencies, games)
+    rows = [
+        f"{index:>3} {game[:12]:<12} {lot_price:>9.2f} {action_price:>8.2f} {currency.upper()} {profit_rub:>9.2f} {profit_mdl:>8.2f}"
+        for index, (game, lot_price, currency, action_price, profit_rub, profit_mdl)
+        in enumerate(zip(games, lot_prices, currencies, action_prices, profits_rub, profits_mdl), 1)
+    ]
+    header = f"{'#':>3} {'Игра':<12} {'Лот RUB':>9} {'Акция':>8} {'':3} {'RUB':>9} {'MDL':>8}"
+    total = (
+        f"\n<b>📊 Лотов:</b> <code>{len(rows)}</code>, "
+        f"<b>💰 Итого:</b> <code>{sum(profits_rub):.2f}</code> RUB / ~<code>{sum(profits_mdl):.2f}</code> MDL"
+    )
+    pages = [
+        f"<pre>{header}\n" + "\n".join(rows[start:start + BULK_PAGE_SIZE]) + f"</pre>{total}"
+        for start in range(0, max(len(rows), 1), BULK_PAGE_SIZE)
+    ]
+    if errors:
+        # Ошибки дописываются, пока самая длинная страница укладывается в MESSAGE_MAX_LENGTH
+        skipped = "\n<b>❗ Пропущено строк:</b> "
+        room = MESSAGE_MAX_LENGTH - max(map(len, pages)) - len(skipped)
+        shown = []
+        for error in errors[:BULK_MAX_ERRORS]:
+            item = f"<code>{html.escape(error)}</code>"
+            room -= len(item) + 2 * bool(shown)
+            if room < 0:
+                break
+            shown.append(item)
+        if shown:
+            pages = [page + skipped + ", ".join(shown) for page in pages]
+    return pages
+
+class KeyboardRegistry:
+    """Статические клавиатуры: строятся один раз и отдаются уже сериализованными в JSON.
+
+    telebot передаёт строку в reply_markup как есть, без повторного to_json().
+    """
+
+    def __init__(self):
+        self._builders = {}
+        self._cache = {}
+
+    def register(self, name: str, *buttons):
+        """Регистрирует клавиатуру из пар (текст, callback_data), по кнопке в ряд."""
+        self._builders[name] = buttons
+        self._cache.pop(name, None)
+
+    def get(self, name: str) -> str:
+        markup = self._cache.get(name)
+        if markup is None:
+            markup = self.build(name).to_json()
+            self._cache[name] = markup
+        return markup
+
+    def build(self, name: str) -> InlineKeyboardMarkup:
+        from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
         markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
-        
-        # Сообщение о вводе цены акции
+        markup.add(*(InlineKeyboardButton(text, callback_data=data) for text, data in self._builders[name]))
+        return markup
+
+keyboards = KeyboardRegistry()
+keyboards.register(
+    "main",
+    ("💳 Обновить курсы", "update_rates"),
+    ("💰 Рассчитать выгоду", "calculate_profit"),
+)
+keyboards.register(
+    "update_rates",
+    *((f"{currency.flag} {currency.label}", f"update_{currency.code.lower()}") for currency in RATE_CURRENCIES),
+    ("🔙 Назад", "back_to_main"),
+)
+keyboards.register("back_to_update_rates", ("🔙 Назад", "back_to_update_rates"))
+keyboards.register("back_to_game_selection", ("🔙 Назад", "back_to_game_selection"))
+
+def register_game_keyboard(registry: GameRegistry):
+    keyboards.register(
+        "game_selection",
+        *((game.title, encode_callback("select_game", game.key, None)) for game in registry),
+        ("🔙 Назад", "back_to_main"),
+    )
+
+game_registry.subscribe(register_game_keyboard)
+
+def render_profit_message(game: Game, currency: str, lot_price_buyer: float, action_price: float,
+                          mdl_price: float, net_profit: float, net_profit_mdl: float, gain=None) -> str:
+    """Сообщение с результатом расчёта; gain — прирост (RUB, MDL) от модификатора комиссии."""
+    profit_message = (
+        f"🇷🇺 Цена {game.item}: <code>{lot_price_buyer:.2f}</code> RUB\n"
+        f"{CURRENCIES[currency.upper()].flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
+        f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
+    )
+    if net_profit < 0:
+        profit_message += (
+            f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
+            f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
+        )
+    else:
+        profit_message += f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB"
+        if gain:  # Показываем прирост только при включённом модификаторе
+            profit_message += f" (<b>+{gain[0]:.2f}</b>)"
+        profit_message += f"\n └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
+        if gain:
+            profit_message += f" (<b>+{gain[1]:.2f}</b>)"
+    return profit_message
+
+def profit_markup(game: Game, currency: str, lot_price_buyer: float, action_price: float, modifier_on: bool = False):
+    """Кнопки под результатом расчёта: модификатор комиссии, пересчёт и навигация."""
+    from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+    markup = InlineKeyboardMarkup(row_width=1)
+    if game.modifier_key:
+        markup.add(InlineKeyboardButton(
+            f"{'🟢' if modifier_on else '🔴'} {game.modifier_title}",
+            callback_data=encode_callback("toggle_modifier", game.key, currency, lot_price_buyer, action_price)
+        ))
+    markup.add(
+        InlineKeyboardButton(f"⚙️ Рассчитать с другой ценой {game.item}", callback_data=encode_callback("recalculate", game.key, currency, action_price)),
+        InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
+        InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
+    )
+    return markup
+
+# Сколько готовых расчётов (текст и кнопки) держать в кэше
+QUOTE_CACHE_SIZE = 1024
+
+class Quote:
+    """Готовый расчёт: выгода, HTML-сообщение и клавиатура в JSON."""
+
+    __slots__ = ("mdl_price", "net_profit", "net_profit_mdl", "text", "markup")
+
+    def __init__(self, mdl_price: float, net_profit: float, net_profit_mdl: float, text: str, markup: str):
+        self.mdl_price = mdl_price
+        self.net_profit = net_profit
+        self.net_profit_mdl = net_profit_mdl
+        self.text = text
+        self.markup = markup
+
+class QuoteCache:
+    """LRU-кэш расчётов выгоды вместе с отрисованным сообщением.
+
+    Ключ — (игра, валюта, режим комиссии, цена лота, цена акции, версия курсов):
+    после изменения курсов старые записи перестают совпадать и вытесняются сами.
+    Повторные расчёты популярных лотов и переключение модификатора туда-обратно
+    обходятся одним поиском в словаре.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, game: Game, currency: str, lot_price_buyer: float, action_price: float, modifier_on: bool = False) -> Quote:
+        # Сам объект Game в ключе: после перезагрузки описания игр записи устаревают
+        mode = game.mode(modifier_on)
+        key = (game, currency, mode, modifier_on, lot_price_buyer, action_price, exchange_rates.version)
+        with self._lock:
+            quote = self._entries.get(key)
+            if quote is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return quote
+            self.misses += 1
+        mdl_price, net_profit, net_profit_mdl = calculate_profit(lot_price_buyer, action_price, currency, mode)
+        gain = None
+        if modifier_on:
+            # Прирост считается относительно расчёта без модификатора
+            base = self.get(game, currency, lot_price_buyer, action_price)
+            gain = (net_profit - base.net_profit, net_profit_mdl - base.net_profit_mdl)
+        quote = Quote(
+            mdl_price, net_profit, net_profit_mdl,
+            render_profit_message(game, currency, lot_price_buyer, action_price, mdl_price, net_profit, net_profit_mdl, gain),
+            profit_markup(game, currency, lot_price_buyer, action_price, modifier_on).to_json(),
+        )
+        with self._lock:
+            self._entries[key] = quote
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return quote
+
+    def __len__(self):
+        return len(self._entries)
+
+quote_cache = QuoteCache(QUOTE_CACHE_SIZE)
+
+# Генерация стартового сообщения
+_main_message_cache = (None, "")
+
+def generate_main_message():
+    """Возвращает стартовое сообщение; текст пересобирается только при смене версии курсов."""
+    global _main_message_cache
+    version, text = _main_message_cache
+    if version == exchange_rates.version:
+        return text
+    version = exchange_rates.version
+    text = "<b>💳 Актуальные курсы валют:</b>\n" + "".join(
+        f"• {currency.flag} <b>{currency.label}:</b> "
+        f"<code>{exchange_rates[currency.code]:.{currency.precision}f}</code> {currency.unit}\n"
+        for currency in RATE_CURRENCIES
+    ) + "\n⚙️ Выберите функцию:"
+    _main_message_cache = (version, text)
+    return text
+
+# Асинхронный режим отправки сообщений (см. AsyncBotAdapter)
+ASYNC_BOT_API = False
+ASYNC_BOT_API_WORKERS = 16
+
+class AsyncBotAdapter:
+    """Асинхронный режим Bot API поверх синхронного бота Cardinal.
+
+    Cardinal сам опрашивает Telegram через TeleBot, поэтому второй AsyncTeleBot
+    с тем же токеном запустить нельзя. Вместо этого send_message,
+    edit_message_text и answer_callback_query уходят в фоновый asyncio-цикл:
+    внутри одного чата вызовы идут строго по порядку, разные чаты обслуживаются
+    параллельно, а обработчик не ждёт ответа Telegram. Остальные методы
+    вызываются напрямую.
+    """
+
+    PIPELINED = ("send_message", "edit_message_text", "answer_callback_query")
+
+    def __init__(self, bot, workers: int = ASYNC_BOT_API_WORKERS):
+        self._bot = bot
+        self._tails = {}
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rate-calculator-api")
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="rate-calculator-async", daemon=True).start()
+
+    def __getattr__(self, name):
+        if name in self.PIPELINED:
+            return functools.partial(self.submit, name)
+        return getattr(self._bot, name)
+
+    def submit(self, name: str, *args, **kwargs):
+        """Ставит вызов метода бота в очередь чата; возвращает concurrent.futures.Future."""
+        if name == "send_message":
+            chat_id = kwargs.get("chat_id", args[0] if args else None)
+        elif name == "edit_message_text":
+            chat_id = kwargs.get("chat_id", args[1] if len(args) > 1 else None)
+        else:
+            chat_id = None
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self._call(chat_id, name, args, kwargs), self._loop)
+
+    async def _call(self, chat_id, name: str, args, kwargs):
+        import asyncio
+        current = asyncio.current_task()
+        previous = None
+        if chat_id is not None:
+            previous = self._tails.get(chat_id)
+            self._tails[chat_id] = current
+        try:
+            if previous is not None:
+                await asyncio.wait((previous,))
+            call = functools.partial(getattr(self._bot, name), *args, **kwargs)
+            return await self._loop.run_in_executor(self._executor, call)
+        except Exception as e:
+            print(f"Ошибка Bot API ({name}): {e}")
+        finally:
+            if chat_id is not None and self._tails.get(chat_id) is current:
+                del self._tails[chat_id]
+
+# Планировщик исходящих сообщений (см. OutboundScheduler). Лимиты Telegram:
+# около 1 сообщения в секунду в чат, 20 в минуту в группу и 30 в секунду всего
+OUTBOUND_SCHEDULER = True
+OUTBOUND_WORKERS = 8
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_GLOBAL_RATE = 30.0
+OUTBOUND_GLOBAL_BURST = 30
+OUTBOUND_MAX_RETRIES = 3
+MESSAGE_MAX_LENGTH = 4096
+
+# Приоритеты исходящих сообщений: меньше — раньше
+PRIORITY_QUOTE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_MENU = 2
+PRIORITY_NAMES = {PRIORITY_QUOTE: "quote", PRIORITY_DEFAULT: "default", PRIORITY_MENU: "menu"}
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst про запас."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+class _Outgoing:
+    __slots__ = ("name", "kwargs", "priority", "futures", "enqueued_at", "attempts")
+
+    def __init__(self, name: str, kwargs: dict, priority: int, future):
+        self.name = name
+        self.kwargs = kwargs
+        self.priority = priority
+        self.futures = [future]
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class _ChatQueue:
+    __slots__ = ("items", "bucket", "not_before", "busy", "scheduled")
+
+    def __init__(self, bucket: TokenBucket):
+        self.items = deque()
+        self.bucket = bucket
+        self.not_before = 0.0
+        self.busy = False
+        self.scheduled = False
+
+class OutboundScheduler:
+    """Очередь send_message и edit_message_text с лимитами Telegram.
+
+    У каждого чата своё ведро токенов и своя очередь: внутри чата сообщения
+    уходят строго по порядку, а между чатами первым обслуживается тот, чьё
+    ближайшее сообщение важнее (priority=PRIORITY_QUOTE раньше PRIORITY_MENU).
+    Пока сообщение ждёт в очереди, следующее в тот же чат дописывается к нему, а
+    новая правка того же сообщения заменяет старую. На 429 чат ставится на паузу
+    retry_after и сообщение повторяется. Вызовы возвращают Future; при
+    OUTBOUND_SCHEDULER = False методы вызываются сразу.
+    """
+
+    SCHEDULED = {
+        "send_message": ("chat_id", "text"),
+        "edit_message_text": ("text", "chat_id", "message_id"),
+    }
+    # Только такие сообщения можно склеивать: остальные параметры потерялись бы
+    MERGEABLE = {"chat_id", "text", "reply_markup", "parse_mode"}
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.enabled = False
+        self._bot = None
+        self._chats = {}
+        self._ready = []  # (приоритет, номер, чат)
+        self._delayed = []  # (время готовности, приоритет, номер, чат)
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._swept_at = 0.0
+        self._global = None
+        self._future = None
+
+    def start(self, bot):
+        """Оборачивает бота; фоновые потоки запускаются, только если планировщик включён."""
+        self._bot = bot
+        self.enabled = OUTBOUND_SCHEDULER
+        if not self.enabled or self._future is not None:
+            return
+        from concurrent.futures import Future
+        self._future = Future
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST, time.monotonic())
+        for index in range(OUTBOUND_WORKERS):
+            threading.Thread(target=self._run, name=f"rate-calculator-outbound-{index}", daemon=True).start()
+
+    def __getattr__(self, name):
+        if name in self.SCHEDULED:
+            return functools.partial(self.submit, name)
+        return getattr(self._bot, name)
+
+    def submit(self, name: str, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        """Ставит вызов в очередь чата; возвращает concurrent.futures.Future."""
+        if not self.enabled:
+            return getattr(self._bot, name)(*args, **kwargs)
+        names = self.SCHEDULED[name]
+        if len(args) > len(names):
+            raise TypeError(f"{name}: передайте параметры после {', '.join(names)} по имени")
+        kwargs.update(zip(names, args))
+        chat_id = kwargs.get("chat_id")
+        future = self._future()
+        with self._cond:
+            now = time.monotonic()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                rate = OUTBOUND_GROUP_RATE if isinstance(chat_id, int) and chat_id < 0 else OUTBOUND_CHAT_RATE
+                chat = self._chats[chat_id] = _ChatQueue(TokenBucket(rate, OUTBOUND_CHAT_BURST, now))
+            last = chat.items[-1] if chat.items else None
+            if last is not None and last.name == name and self._merge(last, kwargs):
+                last.priority = min(last.priority, priority)
+                last.futures.append(future)
+            else:
+                chat.items.append(_Outgoing(name, kwargs, priority, future))
+            self._schedule(chat_id, chat)
+        return future
+
+    def _merge(self, last: _Outgoing, kwargs: dict) -> bool:
+        """Дописывает вызов к ещё не отправленному last; False, если это невозможно."""
+        previous = last.kwargs
+        if last.name == "edit_message_text":
+            if previous.get("message_id") is None or previous.get("message_id") != kwargs.get("message_id"):
+                return False
+            last.kwargs = kwargs
+            self.metrics.increment("outbound.coalesced")
+            return True
+        if previous.get("reply_markup") is not None or not self.MERGEABLE.issuperset(previous) or not self.MERGEABLE.issuperset(kwargs):
+            return False
+        modes = [(parse_mode or "").upper() for parse_mode in (previous.get("parse_mode"), kwargs.get("parse_mode"))]
+        texts = [previous["text"], kwargs["text"]]
+        if modes[0] != modes[1]:
+            if set(modes) != {"", "HTML"}:
+                return False
+            # Простой текст склеивается с HTML после экранирования
+            texts = [text if mode else html.escape(text) for text, mode in zip(texts, modes)]
+        text = f"{texts[0]}\n\n{texts[1]}"
+        if len(text) > MESSAGE_MAX_LENGTH:
+            return False
+        previous.update(text=text, reply_markup=kwargs.get("reply_markup"))
+        if "HTML" in modes:
+            previous["parse_mode"] = "HTML"
+        self.metrics.increment("outbound.merged")
+        return True
+
+    def _schedule(self, chat_id, chat: _ChatQueue):
+        if chat.items and not chat.busy and not chat.scheduled:
+            chat.scheduled = True
+            self._sequence += 1
+            heapq.heappush(self._ready, (chat.items[0].priority, self._sequence, chat_id))
+            self._cond.notify()
+
+    def _next(self):
+        """Ждёт следующее сообщение, которое можно отправить, не нарушая лимитов."""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._delayed)[1:])
+            timeout = None
+            if self._ready:
+                timeout = self._global.delay(now)
+                if not timeout:
+                    priority, sequence, chat_id = heapq.heappop(self._ready)
+                    chat = self._chats[chat_id]
+                    chat_delay = max(chat.not_before - now, chat.bucket.delay(now))
+                    if chat_delay > 0:
+                        heapq.heappush(self._delayed, (now + chat_delay, priority, sequence, chat_id))
+                        continue
+                    self._global.take()
+                    chat.bucket.take()
+                    chat.scheduled = False
+                    chat.busy = True
+                    return chat_id, chat, chat.items.popleft()
+            if self._delayed:
+                timeout = min(timeout or float("inf"), self._delayed[0][0] - now)
+            if now - self._swept_at > 60:
+                self._sweep(now)
+            self._cond.wait(timeout)
+
+    def _sweep(self, now: float):
+        # Чаты без очереди и с полным ведром ничем не отличаются от новых
+        self._swept_at = now
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.items and not chat.busy and chat.not_before <= now and chat.bucket.full(now):
+                del self._chats[chat_id]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                chat_id, chat, item = self._next()
+            self.metrics.observe(f"outbound.wait.{PRIORITY_NAMES.get(item.priority, item.priority)}", time.monotonic() - item.enqueued_at)
+            try:
+                result = getattr(self._bot, item.name)(**item.kwargs)
+            except Exception as e:
+                retry_after = self._retry_after(e)
+                if retry_after is not None and item.attempts < OUTBOUND_MAX_RETRIES:
+                    item.attempts += 1
+                    self.metrics.increment("outbound.retry_after")
+                    with self._cond:
+                        chat.not_before = time.monotonic() + retry_after
+                        chat.items.appendleft(item)
+                        chat.busy = False
+                        self._schedule(chat_id, chat)
+                    continue
+                self.metrics.increment("outbound.failed")
+                print(f"Ошибка Bot API ({item.name}): {e}")
+                for future in item.futures:
+                    future.set_exception(e)
+            else:
+                for future in item.futures:
+                    future.set_result(result)
+            with self._cond:
+                chat.busy = False
+                self._schedule(chat_id, chat)
+
+    @staticmethod
+    def _retry_after(error: Exception):
+        """Пауза из ответа 429 Too Many Requests (или None для других ошибок)."""
+        if getattr(error, "error_code", None) != 429:
+            return None
+        parameters = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+        return float(parameters.get("retry_after", 1))
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(chat.items) + chat.busy for chat in self._chats.values())
+
+    def stop(self, *args, timeout: float = 5.0):
+        """Ждёт отправки очереди (не дольше timeout секунд) при остановке Cardinal."""
+        deadline = time.monotonic() + timeout
+        while self.enabled and self.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+outbound_scheduler = OutboundScheduler(metrics)
+
+def main(cardinal: Cardinal, *args):
+    if not cardinal.telegram:
+        return
+    from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+    tg = cardinal.telegram
+    bot = InstrumentedBot(tg.bot, metrics)
+    if ASYNC_BOT_API:
+        bot = AsyncBotAdapter(bot)
+    # Планировщик всегда снаружи: он же снимает аргумент priority. В асинхронном
+    # режиме ошибки перехватывает AsyncBotAdapter, и retry-after не обрабатывается
+    outbound_scheduler.start(bot)
+    bot = outbound_scheduler
+    rate_history.seed(exchange_rates)
+    conversation_store.open()
+    rate_scheduler.start()
+    metrics_exporter.start()
+    timed = metrics.timed()
+
+    @timed
+    def start_rate(message: Message, edit_message_id: int = None):
+        markup = keyboards.get("main")
+        if edit_message_id:
+            bot.edit_message_text(generate_main_message(), message.chat.id, edit_message_id, reply_markup=markup, parse_mode="HTML", priority=PRIORITY_MENU)
+        else:
+            conversations.end(message.chat.id, message.from_user.id)  # /rate прерывает начатый диалог
+            bot.send_message(message.chat.id, generate_main_message(), reply_markup=markup, parse_mode="HTML", priority=PRIORITY_MENU)
+
+    def show_update_rates(call):
         bot.edit_message_text(
-            f"⚙️ Введите цену акции в {currency.upper()}:",
+            "⚙️ Выберите обновляемый курс:",
             call.message.chat.id,
             call.message.id,
-            reply_markup=markup
+            reply_markup=keyboards.get("update_rates"),
+            priority=PRIORITY_MENU
         )
-        
-        # Сохраняем состояние для пользователя
-        last_requests[user_id] = f"brawl_profit_{currency}_{lot_price}_{lot_price_buyer}"
-        
-        # Регистрируем обработчик для следующего шага
-        bot.register_next_step_handler(call.message, lambda msg: calculate_brawl_profit(msg, currency, lot_price, lot_price_buyer))
-        
-    def toggle_quests(call):
-        data = call.data.split("_")
-        currency, lot_price, lot_price_buyer, action_price = data[2], float(data[3]), float(data[4]), float(data[5])
-        message_id = call.message.id
-        user_id = call.from_user.id
-    
-        # Получаем текущее состояние (инициализируем, если его еще нет)
-        current_state = alternate_commission_states.get(
-            message_id,
-            {"state": False, "profit_rub_off": None, "profit_mdl_off": None}
+
+    def ask_rate_update(call):
+        currency = CURRENCIES[call.data.split("_")[1].upper()]
+        bot.edit_message_text(
+            currency.prompts[0],
+            call.message.chat.id,
+            call.message.id,
+            parse_mode="HTML",
+            reply_markup=keyboards.get("back_to_update_rates")
         )
-        new_state = not current_state["state"]  # Переключаем состояние (включено/выключено)
-    
-        # Пересчитываем себестоимость и чистую выгоду
-        mdl_price = action_price * exchange_rates[currency.upper()]
-        rub_price = mdl_price * exchange_rates["RUB"]
-        commission_rate = 0.08224296149183244 if new_state else 0.16068374059755964
-        lot_price_with_commission = lot_price_buyer * (1 - commission_rate)
-        net_profit = lot_price_with_commission * 0.97 - rub_price
-        net_profit_mdl = net_profit / exchange_rates["RUB"]
-        currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Обновлен выбор флага с учетом BRL
-    
-        # Сохраняем выгоду "выключенного" состояния при первом вызове
-        if current_state["profit_rub_off"] is None:
-            current_state["profit_rub_off"] = lot_price_buyer * (1 - 0.16068374059755964) * 0.97 - rub_price
-            current_state["profit_mdl_off"] = current_state["profit_rub_off"] / exchange_rates["RUB"]
-    
-        # Вычисляем прирост (разница между состояниями)
-        profit_diff_rub = net_profit - current_state["profit_rub_off"]
-        profit_diff_mdl = net_profit_mdl - current_state["profit_mdl_off"]
-    
-        # Обновляем состояние
-        current_state["state"] = new_state
-        alternate_commission_states[message_id] = current_state
-    
-        # Формируем сообщение
-        profit_message = (
-            f"🇷🇺 Цена лота: <code>{lot_price_buyer:.2f}</code> RUB\n"
-            f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-            f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
+        conversations.begin(call.message.chat.id, call.from_user.id, "rate_value", code=currency.code)
+
+    def show_calculate_profit(call):
+        game_registry.refresh()
+        markup = keyboards.get("game_selection")
+        # Проверяем, откуда нажата кнопка
+        if call.message.text and "💰 Чистая выгода" in call.message.text:
+            # Если кнопка нажата после расчёта (чистая выгода уже была показана)
+            bot.send_message(call.message.chat.id, "🎮 Выберите категорию:", reply_markup=markup, priority=PRIORITY_MENU)
+        else:
+            # Если кнопка нажата из главного меню, редактируем сообщение
+            bot.edit_message_text("🎮 Выберите категорию:", call.message.chat.id, call.message.id, reply_markup=markup, priority=PRIORITY_MENU)
+        bot.answer_callback_query(call.id)
+
+    def show_game_selection(call):
+        game_registry.refresh()
+        bot.edit_message_text(
+            "🎮 Выберите категорию:",
+            call.message.chat.id,
+            call.message.id,
+            reply_markup=keyboards.get("game_selection"),
+            priority=PRIORITY_MENU
         )
-    
-        if net_profit < 0:
-            profit_message += (
-                f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-            )
+
+    def ask_lot_price(call):
+        game = game_registry.get(decode_callback(call.data)[0])
+        if game is None:
+            bot.answer_callback_query(call.id, "Игра больше недоступна.")
+            return
+        bot.edit_message_text(game.lot_prompt, call.message.chat.id, call.message.id, reply_markup=keyboards.get("back_to_game_selection"))
+        conversations.begin(call.message.chat.id, call.from_user.id, "lot_price", game=game.key)
+
+    def back_to_main(call):
+        start_rate(call.message, call.message.id)
+
+    def update_rate(message: Message, data: dict):
+        currency = CURRENCIES[data["code"]]
+        try:
+            value = parse_number(message.text, positive=True)
+        except (TypeError, ValueError):
+            bot.send_message(message.chat.id, f"❌ Ошибка: введите {currency.errors[0]}.")
+            return
+        if currency.input == "pair":
+            # Курс по паре сумм: спрашиваем второе число
+            bot.send_message(message.chat.id, currency.prompts[1], reply_markup=keyboards.get("back_to_update_rates"), parse_mode="HTML")
+            conversations.begin(message.chat.id, message.from_user.id, "rate_pair", code=currency.code, first_value=value)
         else:
-            profit_message += f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB"
-            if new_state:  # Показываем прирост только при включенной функции
-                profit_message += f" (<b>+{profit_diff_rub:.2f}</b>)"
-            profit_message += f"\n └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-            if new_state:
-                profit_message += f" (<b>+{profit_diff_mdl:.2f}</b>)"
-    
-        # Обновляем кнопки
-        alternate_commission_text = "🟢 Квесты" if new_state else "🔴 Квесты"
+            set_rate(message, currency, value)
+
+    def finalize_update_rate(message: Message, data: dict):
+        currency = CURRENCIES[data["code"]]
+        try:
+            rate = data["first_value"] / parse_number(message.text, positive=True)
+            if not is_valid_rate(rate):
+                raise ValueError(f"Некорректный курс: {rate}")
+        except (TypeError, ValueError):
+            bot.send_message(message.chat.id, f"❌ Ошибка: введите {currency.errors[1]}.")
+            return
+        set_rate(message, currency, rate)
+
+    def set_rate(message: Message, currency: Currency, rate: float):
+        try:
+            # Хранилище не меняется, если курс некорректен (ноль, nan, переполнение)
+            exchange_rates[currency.code] = rate
+        except ValueError:
+            bot.send_message(message.chat.id, f"❌ Ошибка: введите {currency.errors[-1]}.")
+            return
+        conversations.end(message.chat.id, message.from_user.id)
+        save_exchange_rates()  # Сохраняем обновленные курсы
+        bot.send_message(message.chat.id, f"✅ Курс <b>{currency.flag} {currency.label}</b> успешно обновлён!", parse_mode="HTML")
+        start_rate(message)
+
+    def get_lot_price(message: Message, data: dict):
+        game = game_registry.get(data["game"])
+        if game is None:
+            conversations.end(message.chat.id, message.from_user.id)
+            return
+        try:
+            lot_price_buyer = parse_number(message.text)
+        except (TypeError, ValueError):
+            bot.send_message(message.chat.id, f"❌ Ошибка: введите корректную цену {game.item}.")
+            return
+        conversations.end(message.chat.id, message.from_user.id)
         markup = InlineKeyboardMarkup(row_width=1)
         markup.add(
-            InlineKeyboardButton(alternate_commission_text, callback_data=f"toggle_quests_{currency}_{lot_price}_{lot_price_buyer}_{action_price}"),
-            InlineKeyboardButton("⚙️ Рассчитать с другой ценой лота", callback_data=f"recalculate_brawl_{currency}_{action_price}_{lot_price_buyer}"),
-            InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-            InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
+            *(InlineKeyboardButton(f"{CURRENCIES[currency.upper()].flag} {CURRENCIES[currency.upper()].name}", callback_data=encode_callback("select_currency", game.key, currency, lot_price_buyer))
+              for currency in game.currencies),
+            InlineKeyboardButton("📊 Сравнить все варианты", callback_data=encode_callback("compare", game.key, None, lot_price_buyer)),
+            InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection")
         )
-    
-        # Обновляем сообщение
-        bot.edit_message_text(
-            profit_message,
-            chat_id=call.message.chat.id,
-            message_id=message_id,
-            reply_markup=markup,
-            parse_mode="HTML"
-        )
-        
-    def handle_clash_royale_currency(call):
-        user_id = call.from_user.id
-        data = call.data.split("_")
-        currency = data[2]
-        lot_price = float(data[3])
-        lot_price_buyer = float(data[4])
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
+        bot.send_message(message.chat.id, "⚙️ Выберите валюту акции:", reply_markup=markup)
+
+    def ask_action_price(call):
+        game_key, currency, (lot_price_buyer,) = decode_callback(call.data)
         bot.edit_message_text(
             f"⚙️ Введите цену акции в {currency.upper()}:",
             call.message.chat.id,
             call.message.id,
-            reply_markup=markup
-        )
-        last_requests[user_id] = f"clash_profit_{currency}_{lot_price}_{lot_price_buyer}"
-        bot.register_next_step_handler(call.message, lambda msg: calculate_clash_profit(msg, currency, lot_price, lot_price_buyer))
-        
-    def toggle_items(call):
-        data = call.data.split("_")
-        currency, lot_price, lot_price_buyer, action_price = data[2], float(data[3]), float(data[4]), float(data[5])
-        message_id = call.message.id
-        user_id = call.from_user.id
-    
-        # Получаем текущее состояние (инициализируем, если его еще нет)
-        current_state = alternate_commission_states.get(
-            message_id,
-            {"state": False, "profit_rub_off": None, "profit_mdl_off": None}
+            reply_markup=keyboards.get("back_to_game_selection")
         )
-        new_state = not current_state["state"]  # Переключаем состояние (включено/выключено)
-    
-        # Пересчитываем себестоимость и чистую выгоду
-        mdl_price = action_price * exchange_rates[currency.upper()]
-        rub_price = mdl_price * exchange_rates["RUB"]
-        commission_rate = 0.05576919826590123 if new_state else 0.123214261446109
-        lot_price_with_commission = lot_price_buyer * (1 - commission_rate)
-        net_profit = lot_price_with_commission * 0.97 - rub_price
-        net_profit_mdl = net_profit / exchange_rates["RUB"]
-        currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Обновлен выбор флага с учетом BRL
-    
-        # Сохраняем выгоду "выключенного" состояния при первом вызове
-        if current_state["profit_rub_off"] is None:
-            current_state["profit_rub_off"] = lot_price_buyer * (1 - 0.123214261446109) * 0.97 - rub_price
-            current_state["profit_mdl_off"] = current_state["profit_rub_off"] / exchange_rates["RUB"]
-    
-        # Вычисляем прирост (разница между состояниями)
-        profit_diff_rub = net_profit - current_state["profit_rub_off"]
-        profit_diff_mdl = net_profit_mdl - current_state["profit_mdl_off"]
-    
-        # Обновляем состояние
-        current_state["state"] = new_state
-        alternate_commission_states[message_id] = current_state
-    
-        # Формируем сообщение
-        profit_message = (
-            f"🇷🇺 Цена лота: <code>{lot_price_buyer:.2f}</code> RUB\n"
-            f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-            f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
+        conversations.begin(
+            call.message.chat.id, call.from_user.id, "action_price",
+            game=game_key, currency=currency, lot_price_buyer=lot_price_buyer
         )
-    
-        if net_profit < 0:
-            profit_message += (
-                f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-            )
-        else:
-            profit_message += f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB"
-            if new_state:  # Показываем прирост только при включенной функции
-                profit_message += f" (<b>+{profit_diff_rub:.2f}</b>)"
-            profit_message += f"\n └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-            if new_state:
-                profit_message += f" (<b>+{profit_diff_mdl:.2f}</b>)"
-    
-        # Обновляем кнопки
-        alternate_items_text = "🟢 Предметы" if new_state else "🔴 Предметы"
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            InlineKeyboardButton(alternate_items_text, callback_data=f"toggle_items_{currency}_{lot_price}_{lot_price_buyer}_{action_price}"),
-            InlineKeyboardButton("⚙️ Рассчитать с другой ценой лота", callback_data=f"recalculate_clash_{currency}_{action_price}_{lot_price_buyer}"),
-            InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-            InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-        )
-    
-        # Обновляем сообщение
+
+    def send_profit(chat_id: int, game: Game, currency: str, lot_price_buyer: float, action_price: float):
+        quote = quote_cache.get(game, currency, lot_price_buyer, action_price)
+        profit_ledger.record(game.key, game.mode(), currency, lot_price_buyer, action_price, quote.net_profit, quote.net_profit_mdl)
+        bot.send_message(chat_id, quote.text, reply_markup=quote.markup, parse_mode="HTML", priority=PRIORITY_QUOTE)
+
+    def calculate_game_profit(message: Message, data: dict):
+        game = game_registry.get(data["game"])
+        if game is None:
+            conversations.end(message.chat.id, message.from_user.id)
+            return
+        try:
+            # Вычисляем выражение цены акции
+            action_price = float(evaluate_expression(message.text.replace(",", "+" if game.sum_on_comma else ".")))
+        except (AttributeError, ValueError):
+            bot.send_message(message.chat.id, "❌ Ошибка: введите корректное выражение цены акции.")
+            return
+        conversations.end(message.chat.id, message.from_user.id)
+        send_profit(message.chat.id, game, data["currency"], data["lot_price_buyer"], action_price)
+
+    def toggle_modifier(call):
+        game_key, currency, (lot_price_buyer, action_price) = decode_callback(call.data)
+        game = game_registry.get(game_key)
+        if game is None or not game.modifier_key:
+            bot.answer_callback_query(call.id, "Игра больше недоступна.")
+            return
+        message_id = call.message.id
+
+        # Переключаем состояние модификатора (включено/выключено) для этого сообщения
+        new_state = not alternate_commission_states.get(message_id, False)
+        alternate_commission_states[message_id] = new_state
+
+        # Расчёт и сообщение для каждого состояния берутся из кэша
+        quote = quote_cache.get(game, currency, lot_price_buyer, action_price, new_state)
         bot.edit_message_text(
-            profit_message,
+            quote.text,
             chat_id=call.message.chat.id,
             message_id=message_id,
-            reply_markup=markup,
-            parse_mode="HTML"
+            reply_markup=quote.markup,
+            parse_mode="HTML",
+            priority=PRIORITY_QUOTE
         )
 
-    def handle_telegram_currency(call):
-        user_id = call.from_user.id
-        data = call.data.split("_")
-        currency = data[2]
-        lot_price_buyer = float(data[3])
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
+    def ask_compare_prices(call):
+        game_key, _, (lot_price_buyer,) = decode_callback(call.data)
+        game = game_registry.get(game_key)
+        if game is None:
+            bot.answer_callback_query(call.id, "Игра больше недоступна.")
+            return
         bot.edit_message_text(
-            f"⚙️ Введите цену акции в {currency.upper()}:",
+            f"⚙️ Введите цены акции в {', '.join(currency.upper() for currency in game.currencies)} через пробел\n"
+            "(«-», если акции в этой валюте нет):",
             call.message.chat.id,
             call.message.id,
-            reply_markup=markup
+            reply_markup=keyboards.get("back_to_game_selection")
         )
-        last_requests[user_id] = f"telegram_profit_{currency}_{lot_price_buyer}"
-        bot.register_next_step_handler(call.message, lambda msg: calculate_telegram_profit(msg, currency, lot_price_buyer))
+        conversations.begin(call.message.chat.id, call.from_user.id, "compare_prices", game=game_key, lot_price_buyer=lot_price_buyer)
 
-    def calculate_brawl_profit(message: Message, currency: str, lot_price: float, lot_price_buyer: float, use_alternate_commission: bool = False):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == f"brawl_profit_{currency}_{lot_price}_{lot_price_buyer}":
-            try:
-                # Проверяем ввод и обрабатываем выражения
-                user_input = message.text.replace(",", ".").replace(" ", "")
-                if not all(char.isdigit() or char in "+-*/." for char in user_input):
-                    raise ValueError("Некорректное выражение")
-        
-                action_price = eval(user_input)  # Вычисляем значение выражения
-                mdl_price = action_price * exchange_rates[currency.upper()]
-                rub_price = mdl_price * exchange_rates["RUB"]
-        
-                # Выбор комиссии
-                commission_rate = 0.08224296149183244 if use_alternate_commission else 0.16068374059755964
-                lot_price_with_commission = lot_price_buyer * (1 - commission_rate)
-                net_profit = lot_price_with_commission * 0.97 - rub_price
-                net_profit_mdl = net_profit / exchange_rates["RUB"]
-                currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Обновлен выбор флага с учетом BRL
-        
-                profit_message = (
-                    f"🇷🇺 Цена лота: <code>{lot_price_buyer:.2f}</code> RUB\n"
-                    f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-                    f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
-                )
-        
-                if net_profit < 0:
-                    profit_message += (
-                        f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-                else:
-                    profit_message += (
-                        f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-        
-                # Кнопки
-                alternate_commission_text = "🟢 Квесты" if use_alternate_commission else "🔴 Квесты"
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton(alternate_commission_text, callback_data=f"toggle_quests_{currency}_{lot_price}_{lot_price_buyer}_{action_price}"),
-                    InlineKeyboardButton("⚙️ Рассчитать с другой ценой лота", callback_data=f"recalculate_brawl_{currency}_{action_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-                    InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-                )
-        
-                bot.send_message(message.chat.id, profit_message, reply_markup=markup, parse_mode="HTML")
-        
-            except (ValueError, SyntaxError):
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректное выражение цены акции.")
-                bot.register_next_step_handler(message, lambda msg: calculate_brawl_profit(msg, currency, lot_price, lot_price_buyer, use_alternate_commission))
-
-    def calculate_clash_profit(message: Message, currency: str, lot_price: float, lot_price_buyer: float, use_items: bool = False):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == f"clash_profit_{currency}_{lot_price}_{lot_price_buyer}":
-            try:
-                # Проверяем ввод и обрабатываем выражения
-                user_input = message.text.replace(",", ".").replace(" ", "")
-                if not all(char.isdigit() or char in "+-*/." for char in user_input):
-                    raise ValueError("Некорректное выражение")
-    
-                action_price = eval(user_input)  # Вычисляем значение выражения
-                mdl_price = action_price * exchange_rates[currency.upper()]
-                rub_price = mdl_price * exchange_rates["RUB"]
-    
-                # Выбор комиссии
-                commission_rate = 0.05576919826590123 if use_items else 0.123214261446109
-                lot_price_with_commission = lot_price_buyer * (1 - commission_rate)
-                net_profit = lot_price_with_commission * 0.97 - rub_price
-                net_profit_mdl = net_profit / exchange_rates["RUB"]
-                currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Обновлен выбор флага с учетом BRL
-    
-                profit_message = (
-                    f"🇷🇺 Цена лота: <code>{lot_price_buyer:.2f}</code> RUB\n"
-                    f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-                    f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
-                )
-    
-                if net_profit < 0:
-                    profit_message += (
-                        f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-                else:
-                    profit_message += (
-                        f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-    
-                # Кнопки
-                alternate_items_text = "🔴 Предметы"
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton(alternate_items_text, callback_data=f"toggle_items_{currency}_{lot_price}_{lot_price_buyer}_{action_price}"),
-                    InlineKeyboardButton("⚙️ Рассчитать с другой ценой лота", callback_data=f"recalculate_clash_{currency}_{action_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-                    InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-                )
-    
-                bot.send_message(message.chat.id, profit_message, reply_markup=markup, parse_mode="HTML")
-    
-            except (ValueError, SyntaxError):
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректное выражение цены акции.")
-                bot.register_next_step_handler(message, lambda msg: calculate_clash_profit(msg, currency, lot_price, lot_price_buyer, use_items))
-
-    def calculate_telegram_profit(message: Message, currency: str, lot_price_buyer: float):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == f"telegram_profit_{currency}_{lot_price_buyer}":
-            try:
-                action_price = eval(message.text.replace(',', '+'))
-                mdl_price = action_price * exchange_rates[currency.upper()]
-                rub_price = mdl_price * exchange_rates["RUB"]
-                net_profit = lot_price_buyer - rub_price
-                currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Обновлен выбор флага с учетом BRL
-                net_profit_mdl = net_profit / exchange_rates["RUB"]
-
-                profit_message = (
-                    f"🇷🇺 Цена товара: <code>{lot_price_buyer:.2f}</code> RUB\n"
-                    f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-                    f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
-                )
-
-                if net_profit < 0:
-                    profit_message += (
-                        f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-                else:
-                    profit_message += (
-                        f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton("⚙️ Рассчитать с другой ценой товара", callback_data=f"recalculate_telegram_{currency}_{action_price}_{lot_price_buyer}"),
-                    InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-                    InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-                )
-                bot.send_message(message.chat.id, profit_message, reply_markup=markup, parse_mode="HTML")
-            except (ValueError, SyntaxError):
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректное выражение цены акции.")
-                bot.register_next_step_handler(message, lambda msg: calculate_telegram_profit(msg, currency, lot_price_buyer))
-
-    def recalculate_with_different_brawl_lot(call):
-        user_id = call.from_user.id
-        data = call.data.split("_")
-        currency = data[2]
-        action_price = float(data[3])
-        lot_price_buyer = float(data[4])
-        
+    def calculate_all_scenarios(message: Message, data: dict):
+        game = game_registry.get(data["game"])
+        if game is None:
+            conversations.end(message.chat.id, message.from_user.id)
+            return
+        try:
+            values = (message.text or "").split()
+            if len(values) != len(game.currencies):
+                raise ValueError("Неверное количество цен")
+            action_prices = {
+                currency: float(evaluate_expression(value.replace(",", ".")))
+                for currency, value in zip(game.currencies, values) if value != "-"
+            }
+            if not action_prices:
+                raise ValueError("Нет ни одной цены")
+        except ValueError:
+            bot.send_message(
+                message.chat.id,
+                f"❌ Ошибка: введите {len(game.currencies)} цены акции через пробел, например <code>100 15 -</code>.",
+                parse_mode="HTML"
+            )
+            return
+        conversations.end(message.chat.id, message.from_user.id)
         markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
-        
+        markup.add(
+            InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
+            InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
+        )
+        bot.send_message(message.chat.id, render_scenario_matrix(game, data["lot_price_buyer"], action_prices), reply_markup=markup, parse_mode="HTML", priority=PRIORITY_QUOTE)
+
+    def ask_other_lot_price(call):
+        game_key, currency, (action_price,) = decode_callback(call.data)
+        game = game_registry.get(game_key)
+        if game is None:
+            bot.answer_callback_query(call.id, "Игра больше недоступна.")
+            return
         bot.edit_message_text(
-            "💸 Введите *другую* цену лота в рублях:",
+            f"💸 Введите *другую* цену {game.item} в рублях:",
             call.message.chat.id,
             call.message.id,
             parse_mode="Markdown",
-            reply_markup=markup
+            reply_markup=keyboards.get("back_to_game_selection")
         )
-        last_requests[user_id] = f"recalculate_brawl_{currency}_{action_price}_{lot_price_buyer}"
-        bot.register_next_step_handler(
-            call.message, 
-            lambda msg: calculate_with_different_brawl_lot(msg, currency, action_price, lot_price_buyer)
+        conversations.begin(
+            call.message.chat.id, call.from_user.id, "other_lot_price",
+            game=game_key, currency=currency, action_price=action_price
         )
 
-    def recalculate_with_different_clash_lot(call):
-        user_id = call.from_user.id
-        data = call.data.split("_")
-        currency = data[2]
-        action_price = float(data[3])
-        lot_price_buyer = float(data[4])
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
-        bot.edit_message_text(
-            "💸 Введите *другую* цену лота в рублях:",
-            call.message.chat.id,
-            call.message.id,
-            parse_mode="Markdown",
-            reply_markup=markup
+    def calculate_with_different_lot(message: Message, data: dict):
+        game = game_registry.get(data["game"])
+        if game is None:
+            conversations.end(message.chat.id, message.from_user.id)
+            return
+        try:
+            # Ввод новой цены лота
+            lot_price_buyer = parse_number(message.text)
+        except (TypeError, ValueError):
+            bot.send_message(message.chat.id, f"❌ Ошибка: введите корректную цену {game.item}.")
+            return
+        conversations.end(message.chat.id, message.from_user.id)
+        send_profit(message.chat.id, game, data["currency"], lot_price_buyer, data["action_price"])
+
+    def bulk_page_markup(table_id: int, page: int, pages_count: int):
+        markup = InlineKeyboardMarkup(row_width=3)
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("⬅️", callback_data=encode_callback("bulk_page", None, None, table_id, page - 1)))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages_count}", callback_data=encode_callback("bulk_page", None, None, table_id, page)))
+        if page < pages_count - 1:
+            buttons.append(InlineKeyboardButton("➡️", callback_data=encode_callback("bulk_page", None, None, table_id, page + 1)))
+        markup.row(*buttons)
+        markup.add(InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main"))
+        return markup
+
+    @timed
+    def start_rate_bulk(message: Message):
+        game_registry.refresh()
+        # Список можно передать сразу после команды
+        text = message.text.partition("\n")[2] if message.text else ""
+        if text.strip():
+            handle_bulk_input(message)
+            return
+        bot.send_message(
+            message.chat.id,
+            "📋 Отправьте список лотов (текстом или файлом), по одному в строке:\n"
+            "<code>игра;цена_лота;валюта;цена_акции</code>\n\n"
+            f"Игры: <code>{', '.join(game_registry.mode_factors)}</code>\n"
+            f"Валюты: <code>{', '.join(game_registry.currencies)}</code>",
+            parse_mode="HTML"
         )
-        last_requests[user_id] = f"recalculate_clash_{currency}_{action_price}_{lot_price_buyer}"
-        bot.register_next_step_handler(call.message, lambda msg: calculate_with_different_clash_lot(msg, currency, action_price, lot_price_buyer))
-
-    def recalculate_with_different_telegram_lot(call):
-        user_id = call.from_user.id
-        data = call.data.split("_")
-        currency = data[2]
-        action_price = float(data[3])
-        lot_price_buyer = float(data[4])
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_game_selection"))
+        conversations.begin(message.chat.id, message.from_user.id, "rate_bulk")
+
+    def handle_bulk_input(message: Message, data: dict = None):
+        if message.document:
+            file_info = bot.get_file(message.document.file_id)
+            lines = bot.download_file(file_info.file_path).decode("utf-8", errors="replace").splitlines()
+        else:
+            text = message.text or ""
+            lines = text.partition("\n")[2].splitlines() if text.startswith("/rate_bulk") else text.splitlines()
+        games, lot_prices, currencies, action_prices, errors = parse_bulk_lots(lines)
+        if not games:
+            bot.send_message(message.chat.id, "❌ Ошибка: не найдено ни одного корректного лота.")
+            conversations.begin(message.chat.id, message.from_user.id, "rate_bulk")
+            return
+        conversations.end(message.chat.id, message.from_user.id)
+        pages = render_bulk_pages(games, lot_prices, currencies, action_prices, errors)
+        table_id = next(bulk_table_ids)
+        bulk_tables[(message.from_user.id, table_id)] = pages
+        bot.send_message(
+            message.chat.id,
+            pages[0],
+            reply_markup=bulk_page_markup(table_id, 0, len(pages)),
+            parse_mode="HTML",
+            priority=PRIORITY_QUOTE
+        )
+
+    def handle_bulk_page(call):
+        table_id, page = map(int, decode_callback(call.data)[2])
+        pages = bulk_tables.get((call.from_user.id, table_id))
+        if not pages:
+            bot.answer_callback_query(call.id, "Таблица устарела, отправьте список заново.")
+            return
+        page = min(max(page, 0), len(pages) - 1)
         bot.edit_message_text(
-            "💸 Введите *другую* цену товара в рублях:",
+            pages[page],
             call.message.chat.id,
             call.message.id,
-            parse_mode="Markdown",
-            reply_markup=markup
+            reply_markup=bulk_page_markup(table_id, page, len(pages)),
+            parse_mode="HTML"
         )
-        last_requests[user_id] = f"recalculate_telegram_{currency}_{action_price}_{lot_price_buyer}"
-        bot.register_next_step_handler(call.message, lambda msg: calculate_with_different_telegram_lot(msg, currency, action_price, lot_price_buyer))
+        bot.answer_callback_query(call.id)
 
-    def calculate_with_different_brawl_lot(message: Message, currency: str, action_price: float, original_lot_price_buyer: float):
-        user_id = message.from_user.id
-        
-        if last_requests.get(user_id) == f"recalculate_brawl_{currency}_{action_price}_{original_lot_price_buyer}":
-            try:
-                # Ввод новой цены лота
-                new_lot_price_buyer = float(message.text)
-                lot_price = new_lot_price_buyer * (1 - 0.16068374059755964)
-                mdl_price = action_price * exchange_rates[currency.upper()]
-                rub_price = mdl_price * exchange_rates["RUB"]
-                
-                # Рассчитываем чистую выгоду
-                net_profit = lot_price * 0.97 - rub_price
-                net_profit_mdl = net_profit / exchange_rates["RUB"]
-                currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Исправлен выбор флага
-                
-                # Сохраняем для "Другая комиссия", инициализируя как выключенное состояние
-                alternate_commission_states[message.id] = {
-                    "state": False,  # По умолчанию выключено
-                    "profit_rub_off": net_profit,
-                    "profit_mdl_off": net_profit_mdl
-                }
-    
-                # Формируем сообщение
-                profit_message = (
-                    f"🇷🇺 Цена лота: <code>{new_lot_price_buyer:.2f}</code> RUB\n"
-                    f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-                    f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
-                )
-                if net_profit < 0:
-                    profit_message += (
-                        f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-                else:
-                    profit_message += (
-                        f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-    
-                # Кнопки
-                alternate_commission_text = "🔴 Квесты"  # По умолчанию выключено
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton(alternate_commission_text, callback_data=f"toggle_quests_{currency}_{lot_price}_{new_lot_price_buyer}_{action_price}"),
-                    InlineKeyboardButton("⚙️ Рассчитать с другой ценой лота", callback_data=f"recalculate_brawl_{currency}_{action_price}_{new_lot_price_buyer}"),
-                    InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-                    InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-                )
-    
-                # Отправляем сообщение
-                bot.send_message(message.chat.id, profit_message, reply_markup=markup, parse_mode="HTML")
-    
-            except ValueError:
-                # Обрабатываем ошибки ввода
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректную цену лота.")
-                bot.register_next_step_handler(
-                    message, 
-                    lambda msg: calculate_with_different_brawl_lot(msg, currency, action_price, original_lot_price_buyer)
-                )
-                
-    def calculate_with_different_clash_lot(message: Message, currency: str, action_price: float, original_lot_price_buyer: float):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == f"recalculate_clash_{currency}_{action_price}_{original_lot_price_buyer}":
-            try:
-                new_lot_price_buyer = float(message.text)
-                lot_price = new_lot_price_buyer * (1 - 0.123214261446109)
-                mdl_price = action_price * exchange_rates[currency.upper()]
-                rub_price = mdl_price * exchange_rates["RUB"]
-    
-                net_profit = lot_price * 0.97 - rub_price
-                net_profit_mdl = net_profit / exchange_rates["RUB"]
-                currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Исправлен выбор флага
-    
-                # Сохраняем состояние "Предметы"
-                alternate_commission_states[message.id] = {
-                    "state": False,  # По умолчанию выключено
-                    "profit_rub_off": net_profit,
-                    "profit_mdl_off": net_profit_mdl
-                }
-    
-                # Формируем сообщение
-                profit_message = (
-                    f"🇷🇺 Цена лота: <code>{new_lot_price_buyer:.2f}</code> RUB\n"
-                    f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-                    f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
-                )
-    
-                if net_profit < 0:
-                    profit_message += (
-                        f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-                else:
-                    profit_message += (
-                        f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-    
-                # Кнопки
-                alternate_items_text = "🔴 Предметы"  # По умолчанию выключено
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton(alternate_items_text, callback_data=f"toggle_items_{currency}_{lot_price}_{new_lot_price_buyer}_{action_price}"),
-                    InlineKeyboardButton("⚙️ Рассчитать с другой ценой лота", callback_data=f"recalculate_clash_{currency}_{action_price}_{new_lot_price_buyer}"),
-                    InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-                    InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-                )
-    
-                bot.send_message(message.chat.id, profit_message, reply_markup=markup, parse_mode="HTML")
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректное значение.")
-                bot.register_next_step_handler(message, lambda msg: calculate_with_different_clash_lot(msg, currency, action_price, original_lot_price_buyer))
-                
-    def calculate_with_different_telegram_lot(message: Message, currency: str, action_price: float, original_lot_price_buyer: float):
-        user_id = message.from_user.id
-        if last_requests.get(user_id) == f"recalculate_telegram_{currency}_{action_price}_{original_lot_price_buyer}":
-            try:
-                new_lot_price_buyer = float(message.text)
-                mdl_price = action_price * exchange_rates[currency.upper()]
-                rub_price = mdl_price * exchange_rates["RUB"]
-                net_profit = new_lot_price_buyer - rub_price
-                net_profit_mdl = net_profit / exchange_rates["RUB"]
-                currency_flag = "🇺🇦" if currency == "uah" else "🇧🇷" if currency == "brl" else "🇺🇲"  # Исправлен выбор флага
-
-                profit_message = (
-                    f"🇷🇺 Цена товара: <code>{new_lot_price_buyer:.2f}</code> RUB\n"
-                    f"{currency_flag} Цена акции: <code>{action_price:.2f}</code> {currency.upper()}\n"
-                    f"🇲🇩 Себестоимость: <code>{mdl_price:.2f}</code> MDL\n\n"
-                )
+    @timed
+    def show_rate_history(message: Message):
+        # /rate_history [валюта] [дней]
+        args = message.text.split()[1:]
+        now = time.time()
+        if not args:
+            lines = ["<b>📈 Курсы за сутки:</b>"]
+            for currency, rate in exchange_rates.items():
+                previous = rate_history.as_of(currency, now - 86400)
+                change = f"{rate - previous:+.4f}" if previous is not None else "—"
+                lines.append(f"• <b>{currency}:</b> <code>{rate:.4f}</code> ({change})")
+            lines.append("\nПодробнее: <code>/rate_history USD 7</code>")
+            bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+            return
+        currency = args[0].upper()
+        try:
+            days = min(max(int(args[1]), 1), 90) if len(args) > 1 else 7
+        except ValueError:
+            days = 7
+        if currency not in exchange_rates:
+            bot.send_message(message.chat.id, f"❌ Ошибка: неизвестная валюта. Доступны: {', '.join(exchange_rates)}.")
+            return
+        today = now - now % 86400
+        candles = rate_history.ohlc(currency, today - (days - 1) * 86400, now, 86400)
+        rows = [
+            f"{time.strftime('%d.%m', time.gmtime(day))} {opening:>8.4f} {high:>8.4f} {low:>8.4f} {close:>8.4f}"
+            for day, opening, high, low, close in candles
+        ]
+        header = f"{'День':<5} {'Откр.':>8} {'Макс.':>8} {'Мин.':>8} {'Закр.':>8}"
+        text = f"<b>📈 {currency} за {days} дн.:</b>\n<pre>{header}\n" + ("\n".join(rows) or "нет данных") + "</pre>"
+        bot.send_message(message.chat.id, text, parse_mode="HTML")
 
-                if net_profit < 0:
-                    profit_message += (
-                        f"<b>❗ Убыток:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-                else:
-                    profit_message += (
-                        f"<b>💰 Чистая выгода:</b> <code>{net_profit:.2f}</code> RUB\n"
-                        f" └ 🇲🇩: ~<code>{net_profit_mdl:.2f}</code> MDL"
-                    )
-
-                markup = InlineKeyboardMarkup(row_width=1)
-                markup.add(
-                    InlineKeyboardButton("⚙️ Рассчитать с другой ценой товара", callback_data=f"recalculate_telegram_{currency}_{action_price}_{new_lot_price_buyer}"),
-                    InlineKeyboardButton("🔁 Рассчитать ещё раз", callback_data="calculate_profit"),
-                    InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")
-                )
-                bot.send_message(message.chat.id, profit_message, reply_markup=markup, parse_mode="HTML")
-            except (ValueError, SyntaxError):
-                bot.send_message(message.chat.id, "❌ Ошибка: введите корректное выражение цены товара.")
-                bot.register_next_step_handler(message, lambda msg: calculate_with_different_telegram_lot(msg, currency, action_price, original_lot_price_buyer))
-                
-    # Регистрация команды /rate
+    @timed
+    def solve_lot_price(message: Message):
+        # /rate_solve <цена акции> [маржа, %]
+        game_registry.refresh()
+        args = message.text.split()[1:]
+        try:
+            action_price = float(evaluate_expression(args[0].replace(",", ".")))
+            margin = parse_number(args[1].rstrip("%").replace(",", ".")) / 100 if len(args) > 1 else TARGET_MARGIN
+        except (IndexError, ValueError):
+            bot.send_message(
+                message.chat.id,
+                "❌ Ошибка: укажите цену акции и, при желании, маржу в процентах: <code>/rate_solve 100 15</code>",
+                parse_mode="HTML"
+            )
+            return
+        bot.send_message(message.chat.id, render_min_lot_prices(action_price, margin), parse_mode="HTML", priority=PRIORITY_QUOTE)
+
+    @timed
+    def show_rate_stats(message: Message):
+        cache = (
+            f"\n• Кэш расчётов: <code>{quote_cache.hit_ratio:.0%}</code> попаданий "
+            f"({quote_cache.hits}/{quote_cache.hits + quote_cache.misses}, записей {len(quote_cache)})"
+        )
+        bot.send_message(message.chat.id, f"{render_metrics_table()}{cache}\n\n{render_provider_status()}", parse_mode="HTML")
+
+    @timed
+    def show_rate_report(message: Message):
+        # /rate_report [дней]
+        args = message.text.split()[1:]
+        try:
+            days = min(max(int(args[0]), 1), 90) if args else 7
+        except ValueError:
+            days = 7
+        bot.send_message(message.chat.id, render_profit_report(days), parse_mode="HTML")
+
+    # Регистрация команд /rate, /rate_bulk, /rate_history, /rate_solve, /rate_stats и /rate_report
     cardinal.add_telegram_commands(UUID, [
-        ("rate", "Обновить курсы и рассчитать выгоду.", True)
+        ("rate", "Обновить курсы и рассчитать выгоду.", True),
+        ("rate_bulk", "Рассчитать выгоду для списка лотов.", True),
+        ("rate_history", "История курсов валют.", True),
+        ("rate_solve", "Минимальная цена лота для нужной маржи.", True),
+        ("rate_stats", "Задержки обработчиков и Bot API.", True),
+        ("rate_report", "Сводка расчётов выгоды по дням и неделям.", True)
     ])
     bot.register_message_handler(start_rate, commands=["rate"])
-    bot.register_callback_query_handler(handle_callback, func=lambda call: call.data.startswith("update_") or call.data == "calculate_profit" or call.data == "back_to_main" or call.data == "back_to_update_rates" or call.data == "brawl_stars" or call.data == "clash_royale" or call.data == "telegram" or call.data == "back_to_game_selection")
-    bot.register_callback_query_handler(handle_brawl_stars_currency, func=lambda call: call.data.startswith("brawl_profit_"))
-    bot.register_callback_query_handler(toggle_quests, func=lambda call: call.data.startswith("toggle_quests_"))
-    bot.register_callback_query_handler(handle_clash_royale_currency, func=lambda call: call.data.startswith("clash_profit_"))
-    bot.register_callback_query_handler(toggle_items, func=lambda call: call.data.startswith("toggle_items_"))
-    bot.register_callback_query_handler(handle_telegram_currency, func=lambda call: call.data.startswith("telegram_profit_"))
-    bot.register_callback_query_handler(recalculate_with_different_brawl_lot, func=lambda call: call.data.startswith("recalculate_brawl_"))
-    bot.register_callback_query_handler(recalculate_with_different_clash_lot, func=lambda call: call.data.startswith("recalculate_clash_"))
-    bot.register_callback_query_handler(recalculate_with_different_telegram_lot, func=lambda call: call.data.startswith("recalculate_telegram_"))
+    bot.register_message_handler(start_rate_bulk, commands=["rate_bulk"])
+    bot.register_message_handler(show_rate_history, commands=["rate_history"])
+    bot.register_message_handler(solve_lot_price, commands=["rate_solve"])
+    bot.register_message_handler(show_rate_stats, commands=["rate_stats"])
+    bot.register_message_handler(show_rate_report, commands=["rate_report"])
+
+    # Ответы в диалогах: шаг диалога определяется одним поиском по (чат, пользователь)
+    conversations.on("rate_value", update_rate)
+    conversations.on("rate_pair", finalize_update_rate)
+    conversations.on("lot_price", get_lot_price)
+    conversations.on("action_price", calculate_game_profit)
+    conversations.on("compare_prices", calculate_all_scenarios)
+    conversations.on("other_lot_price", calculate_with_different_lot)
+    conversations.on("rate_bulk", handle_bulk_input)
+    bot.register_message_handler(conversations.dispatch, func=conversations.matches, content_types=["text", "document"])
+
+    # Все кнопки плагина обслуживает один маршрутизатор
+    router = callback_router
+    router.bot = bot
+    for data in ("update_rates", "back_to_update_rates"):
+        router.add(data, show_update_rates, reset_request=True)
+    for data in (f"update_{currency.code.lower()}" for currency in RATE_CURRENCIES):
+        router.add(data, ask_rate_update, reset_request=True)
+    router.add("calculate_profit", show_calculate_profit, reset_request=True)
+    router.add("back_to_game_selection", show_game_selection, reset_request=True)
+    router.add("back_to_main", back_to_main, reset_request=True)
+    router.add_prefix("select_game", ask_lot_price, reset_request=True)
+    router.add_prefix("select_currency", ask_action_price)
+    router.add_prefix("toggle_modifier", toggle_modifier)
+    router.add_prefix("recalculate", ask_other_lot_price)
+    router.add_prefix("compare", ask_compare_prices)
+    router.add_prefix("bulk_page", handle_bulk_page)
+    bot.register_callback_query_handler(router.dispatch, func=router.matches)
 
 BIND_TO_PRE_INIT = [main]
+BIND_TO_PRE_STOP = [outbound_scheduler.stop, rate_scheduler.stop, metrics_exporter.stop, flush_exchange_rates, conversation_store.close, profit_ledger.close]
 BIND_TO_DELETE = None
\ No newline at end of file
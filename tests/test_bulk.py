@@ -0,0 +1,31 @@
+"""Пакетный расчёт /rate_bulk: страницы укладываются в лимит сообщения Telegram."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+RATES = {"RUB": 5.5, "UAH": 0.44, "BRL": 3.5, "USD": 18.6}
+
+
+def test_long_error_fields_are_truncated(monkeypatch):
+    monkeypatch.setattr(plugin, "exchange_rates", plugin.RateStore(lambda: RATES))
+    lines = ["brawl;100;uah;50"] + [f"{'x' * 600};100;uah;50" for _ in range(10)] + [f"brawl;100;{'y' * 600};50"]
+    games, lot_prices, currencies, action_prices, errors = plugin.parse_bulk_lots(lines)
+    assert games == ["brawl"]
+    assert len(errors) == 11
+    assert all(len(error) < 80 for error in errors)
+    pages = plugin.render_bulk_pages(games, lot_prices, currencies, action_prices, errors)
+    assert len(pages) == 1
+    assert len(pages[0]) <= plugin.MESSAGE_MAX_LENGTH
+    assert pages[0].count("<code>") - 3 == plugin.BULK_MAX_ERRORS  # три <code> в строке итога
+
+
+def test_error_list_never_overflows_a_full_page(monkeypatch):
+    monkeypatch.setattr(plugin, "exchange_rates", plugin.RateStore(lambda: RATES))
+    monkeypatch.setattr(plugin, "BULK_FIELD_PREVIEW", 2000)
+    lines = ["brawl;100;uah;50"] * plugin.BULK_PAGE_SIZE + [f"{'x' * 600};100;uah;50" for _ in range(10)]
+    pages = plugin.render_bulk_pages(*plugin.parse_bulk_lots(lines))
+    assert all(len(page) <= plugin.MESSAGE_MAX_LENGTH for page in pages)
+    assert "Пропущено строк" in pages[0]
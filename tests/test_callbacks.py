@@ -0,0 +1,64 @@
+"""Формат callback_data и маршрутизатор кнопок CallbackRouter."""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+
+def test_round_trip_and_prefix():
+    data = plugin.encode_callback("recalculate", "brawl", "uah", 123.45)
+    assert data.startswith(plugin.CALLBACK_PREFIX)
+    assert len(data.encode()) <= 64
+    assert plugin.decode_callback(data) == ("brawl", "uah", (123.45,))
+    assert plugin.decode_callback(plugin.encode_callback("bulk_page", None, None, 3, 1)) == (None, None, (3.0, 1.0))
+
+
+@pytest.mark.parametrize("data", [
+    "rate_gs",
+    "rate_gs:brawl:!!!",
+    "rate_pg::" + plugin.encode_callback("bulk_page", None, None, float("nan")).split(":")[2],
+    "rate_sc:brawl:-w",  # индекс валюты вне таблицы
+])
+def test_decode_rejects_malformed(data):
+    with pytest.raises(ValueError):
+        plugin.decode_callback(data)
+
+
+class FakeBot:
+    def __init__(self):
+        self.answers = []
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.answers.append((callback_query_id, text))
+
+
+def call(data):
+    return SimpleNamespace(id="cb", data=data, from_user=SimpleNamespace(id=1), message=SimpleNamespace(chat=SimpleNamespace(id=1)))
+
+
+def test_router_ignores_foreign_buttons():
+    router = plugin.CallbackRouter()
+    router.add_prefix("select_game", lambda call: None)
+    router.add("back_to_main", lambda call: None)
+    assert router.matches(call(plugin.encode_callback("select_game", "brawl", None)))
+    assert router.matches(call("back_to_main"))
+    for data in ("gs:brawl:_w", "pg::AAAA", "tm:", "other:1", ""):
+        assert not router.matches(call(data))
+
+
+def test_router_answers_malformed_buttons():
+    router = plugin.CallbackRouter()
+    router.bot = FakeBot()
+    handled = []
+    router.add_prefix("recalculate", lambda call: handled.append(plugin.decode_callback(call.data)))
+    router.dispatch(call("rate_rl:brawl:!!!"))
+    assert not handled
+    assert router.bot.answers == [("cb", "❌ Кнопка устарела, откройте меню заново.")]
+    router.dispatch(call(plugin.encode_callback("recalculate", "brawl", "uah", 10.0)))
+    assert handled == [("brawl", "uah", (10.0,))]
+    assert len(router.bot.answers) == 1
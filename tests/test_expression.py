@@ -0,0 +1,91 @@
+"""Поведение калькулятора цены акции (compile_expression / evaluate_expression)."""
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+evaluate = plugin.evaluate_expression
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2+3*4", "14"),
+    ("2*3+4", "10"),
+    ("10-4-3", "3"),
+    ("8/4/2", "1"),
+    ("-5+2", "-3"),
+    ("-2*-3", "6"),
+    ("--5", "5"),
+    ("+7", "7"),
+    ("0.1+0.2", "0.3"),
+    (".5*4", "2.0"),
+])
+def test_precedence_and_unary_minus(text, expected):
+    assert evaluate(text) == Decimal(expected)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("(2+3)*4", "20"),
+    ("-(2+3)*2", "-10"),
+    ("((1+2)*(3+4))", "21"),
+    (" ( 10 - 2 ) / 4 ", "2"),
+])
+def test_parentheses(text, expected):
+    assert evaluate(text) == Decimal(expected)
+
+
+def test_comma_as_sum_and_decimal_comma():
+    # Игры с sum_on_comma складывают суммы через запятую, остальные читают её как точку
+    assert evaluate("100,50".replace(",", "+")) == Decimal("150")
+    assert evaluate("100,50".replace(",", ".")) == Decimal("100.50")
+    assert evaluate("50+50,25".replace(",", "+")) == Decimal("125")
+
+
+def test_length_limit():
+    assert evaluate("1" * plugin.MAX_EXPRESSION_LENGTH) == Decimal("1" * plugin.MAX_EXPRESSION_LENGTH)
+    with pytest.raises(plugin.ExpressionError, match="длинное"):
+        evaluate("1" * (plugin.MAX_EXPRESSION_LENGTH + 1))
+
+
+def test_node_limit():
+    tokens = plugin.MAX_EXPRESSION_NODES // 2
+    evaluate("+".join(["1"] * tokens))
+    with pytest.raises(plugin.ExpressionError, match="сложное"):
+        evaluate("+".join(["1"] * (tokens + 1)))
+
+
+def test_division_by_zero():
+    with pytest.raises(plugin.ExpressionError, match="ноль"):
+        evaluate("1/0")
+    with pytest.raises(plugin.ExpressionError, match="ноль"):
+        evaluate("5/(2-2)")
+
+
+@pytest.mark.parametrize("text", [
+    "9**9**9",
+    "2**3",
+    "abs",
+    "__import__('os')",
+    "x+1",
+    "1e5",
+    "inf",
+    "nan",
+    "",
+    "(1+2",
+    "1+2)",
+    "1 2",
+    "1+",
+    "*3",
+])
+def test_rejected_inputs(text):
+    with pytest.raises(ValueError):
+        evaluate(text)
+
+
+def test_errors_are_value_errors():
+    # Обработчики ловят ValueError: ExpressionError не должен проскакивать мимо
+    assert issubclass(plugin.ExpressionError, ValueError)
@@ -0,0 +1,39 @@
+"""Импорт плагина дешёвый: без тяжёлых модулей и без работы с файлами."""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES = ("telebot", "asyncio", "urllib.request", "concurrent.futures", "sqlite3")
+
+
+def test_import_is_lazy(tmp_path):
+    workdir, tmpdir = tmp_path / "work", tmp_path / "tmp"
+    workdir.mkdir()
+    tmpdir.mkdir()
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))),
+        PYTHONDONTWRITEBYTECODE="1",
+        TMPDIR=str(tmpdir),
+    )
+    # Аудит-хук видит и удалённые потом файлы, например пробный файл tempfile.gettempdir()
+    check = (
+        "import json, os, sys\n"
+        "writes = []\n"
+        "def audit(event, args):\n"
+        "    if event == 'open' and isinstance(args[0], str) and ("
+        "(args[1] or '').strip('rbt') or args[2] & (os.O_WRONLY | os.O_RDWR | os.O_CREAT)):\n"
+        "        writes.append(args[0])\n"
+        "sys.addaudithook(audit)\n"
+        "import rate_calculator_plugin\n"
+        f"print(json.dumps([[name for name in {LAZY_MODULES!r} if name in sys.modules], writes]))"
+    )
+    result = subprocess.run([sys.executable, "-c", check], cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    lazy_loaded, writes = json.loads(result.stdout)
+    assert lazy_loaded == []
+    assert writes == []
+    # Ни файлов курсов, игр и журнала в папке Cardinal, ни пробных файлов во временной папке
+    assert os.listdir(workdir) == []
+    assert os.listdir(tmpdir) == []
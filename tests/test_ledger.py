@@ -0,0 +1,32 @@
+"""ProfitLedger не теряет расчёты, если запись в SQLite не удалась."""
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+RATES = {"RUB": 5.5, "UAH": 0.44}
+
+
+def test_failed_flush_keeps_batch(tmp_path, monkeypatch):
+    ledger = plugin.ProfitLedger(str(tmp_path / "ledger.sqlite3"), 3600)
+    monkeypatch.setattr(ledger, "_thread", object())  # без фонового потока
+    for net_rub in (50.0, -5.0):
+        ledger.record("brawl", "quests", "uah", 1000.0, 100.0, net_rub, 10.0, RATES)
+    connect = ledger._connect
+
+    def broken():
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(ledger, "_connect", broken)
+    ledger.flush()
+    assert [row[8] for row in ledger._queue] == [50.0, -5.0]
+
+    monkeypatch.setattr(ledger, "_connect", connect)
+    ledger.record("brawl", "quests", "uah", 500.0, 100.0, 20.0, 4.0, RATES)
+    (_, quotes, losses, lot_total, net_rub, _), = ledger.report("daily", 0)
+    assert (quotes, losses, lot_total, net_rub) == (3, 1, 2500.0, 65.0)
+    assert [row[0] for row in ledger._db.execute("SELECT net_rub FROM quotes ORDER BY id")] == [50.0, -5.0, 20.0]
+    ledger.close()
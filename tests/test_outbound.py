@@ -0,0 +1,160 @@
+"""Планировщик исходящих OutboundScheduler: порядок, склейка, правки и повтор после 429."""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+TIMEOUT = 5
+
+
+class TooManyRequests(Exception):
+    """Ошибка 429 в том же виде, что telebot.apihelper.ApiTelegramException."""
+
+    error_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too Many Requests")
+        self.result_json = {"ok": False, "error_code": 429, "parameters": {"retry_after": retry_after}}
+
+
+class FakeBot:
+    """Записывает вызовы; первый вызов с текстом "hold" ждёт release(), пока копится очередь."""
+
+    def __init__(self, failures: int = 0):
+        self.calls = []
+        self.failures = failures
+        self.holding = threading.Event()
+        self._released = threading.Event()
+        self._lock = threading.Lock()
+
+    def release(self):
+        self._released.set()
+
+    def _call(self, name, kwargs):
+        if kwargs.get("text") == "hold":
+            self.holding.set()
+            assert self._released.wait(TIMEOUT)
+        with self._lock:
+            self.calls.append((name, kwargs))
+            if self.failures:
+                self.failures -= 1
+                raise TooManyRequests(0)
+        return kwargs["text"]
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call("send_message", dict(kwargs, chat_id=chat_id, text=text))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self._call("edit_message_text", dict(kwargs, chat_id=chat_id, message_id=message_id, text=text))
+
+
+def hold(scheduler, bot):
+    """Занимает чат 1 вызовом, который ждёт release(): следующие сообщения остаются в очереди."""
+    future = scheduler.send_message(1, "hold")
+    assert bot.holding.wait(TIMEOUT)
+    return future
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    # Лимиты не мешают тестам: проверяется только логика очереди
+    monkeypatch.setattr(plugin, "OUTBOUND_SCHEDULER", True)
+    monkeypatch.setattr(plugin, "OUTBOUND_CHAT_RATE", 1000.0)
+    monkeypatch.setattr(plugin, "OUTBOUND_CHAT_BURST", 1000)
+    monkeypatch.setattr(plugin, "OUTBOUND_WORKERS", 4)
+    return plugin.OutboundScheduler(plugin.Metrics())
+
+
+def test_messages_in_one_chat_keep_order(scheduler):
+    bot = FakeBot()
+    scheduler.start(bot)
+    futures = [hold(scheduler, bot)]
+    futures += [scheduler.send_message(1, f"m{index}", reply_markup=f"kb{index}") for index in range(20)]
+    bot.release()
+    assert [future.result(TIMEOUT) for future in futures] == ["hold"] + [f"m{index}" for index in range(20)]
+    assert [kwargs["text"] for _, kwargs in bot.calls] == ["hold"] + [f"m{index}" for index in range(20)]
+
+
+def test_queued_message_with_keyboard_is_not_merged(scheduler):
+    bot = FakeBot()
+    scheduler.start(bot)
+    held = hold(scheduler, bot)
+    with_keyboard = scheduler.send_message(1, "menu", reply_markup="kb")
+    plain = scheduler.send_message(1, "next")
+    last = scheduler.send_message(1, "last", reply_markup="kb2")
+    bot.release()
+    for future in (held, with_keyboard, plain, last):
+        future.result(TIMEOUT)
+    assert [(kwargs["text"], kwargs.get("reply_markup")) for _, kwargs in bot.calls] == [
+        ("hold", None), ("menu", "kb"), ("next\n\nlast", "kb2")
+    ]
+    assert plain.result() == last.result() == "next\n\nlast"
+    assert scheduler.metrics.counters["outbound.merged"] == 1
+
+
+def test_plain_text_is_escaped_when_merged_into_html(scheduler):
+    bot = FakeBot()
+    scheduler.start(bot)
+    futures = [
+        hold(scheduler, bot),
+        scheduler.send_message(1, "a < b & c"),
+        scheduler.send_message(1, "<b>итог</b>", parse_mode="HTML"),
+    ]
+    bot.release()
+    for future in futures:
+        future.result(TIMEOUT)
+    _, kwargs = bot.calls[1]
+    assert kwargs["text"] == "a &lt; b &amp; c\n\n<b>итог</b>"
+    assert kwargs["parse_mode"] == "HTML"
+    assert len(bot.calls) == 2
+
+
+def test_newer_edit_replaces_queued_one(scheduler):
+    bot = FakeBot()
+    scheduler.start(bot)
+    held = hold(scheduler, bot)
+    first = scheduler.edit_message_text("v1", 1, 7, reply_markup="kb")
+    second = scheduler.edit_message_text("v2", 1, 7, reply_markup="kb")
+    other = scheduler.edit_message_text("other", 1, 8)
+    bot.release()
+    for future in (held, first, second, other):
+        future.result(TIMEOUT)
+    edits = [(kwargs["message_id"], kwargs["text"]) for name, kwargs in bot.calls if name == "edit_message_text"]
+    assert edits == [(7, "v2"), (8, "other")]
+    assert first.result() == second.result() == "v2"
+    assert scheduler.metrics.counters["outbound.coalesced"] == 1
+
+
+def test_retry_after_then_success(scheduler):
+    bot = FakeBot(failures=1)
+    scheduler.start(bot)
+    assert scheduler.send_message(1, "quote").result(TIMEOUT) == "quote"
+    assert len(bot.calls) == 2
+    assert scheduler.metrics.counters["outbound.retry_after"] == 1
+
+
+def test_retry_after_gives_up_after_max_retries(scheduler):
+    bot = FakeBot(failures=100)
+    scheduler.start(bot)
+    future = scheduler.send_message(1, "quote")
+    with pytest.raises(TooManyRequests):
+        future.result(TIMEOUT)
+    assert len(bot.calls) == plugin.OUTBOUND_MAX_RETRIES + 1
+    assert scheduler.metrics.counters["outbound.failed"] == 1
+    # Чат не остаётся заблокированным после ошибки
+    bot.failures = 0
+    assert scheduler.send_message(1, "next").result(TIMEOUT) == "next"
+
+
+def test_disabled_scheduler_calls_bot_directly(monkeypatch):
+    monkeypatch.setattr(plugin, "OUTBOUND_SCHEDULER", False)
+    scheduler = plugin.OutboundScheduler(plugin.Metrics())
+    bot = FakeBot()
+    scheduler.start(bot)
+    assert scheduler.send_message(1, "now", priority=plugin.PRIORITY_QUOTE) == "now"
+    assert bot.calls == [("send_message", {"chat_id": 1, "text": "now"})]
@@ -0,0 +1,78 @@
+"""Некорректные курсы и суммы: RateStore не меняется, расчёты бросают ValueError."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+RATES = {"RUB": 5.5, "UAH": 0.44, "BRL": 3.5, "USD": 18.6}
+
+
+@pytest.mark.parametrize("currency, rate", [
+    ("USD", 0.0),
+    ("USD", -1.0),
+    ("USD", float("nan")),
+    ("USD", float("inf")),
+    ("RUB", 0.0),
+    ("RUB", 1e-320),  # 1 / курс переполняется
+])
+def test_invalid_rate_leaves_store_unchanged(currency, rate):
+    store = plugin.RateStore(lambda: RATES)
+    changes = []
+    store.subscribe(lambda *change: changes.append(change))
+    matrix = [row[:] for row in store.cross.matrix]
+    with pytest.raises(ValueError):
+        store[currency] = rate
+    assert dict(store) == RATES
+    assert store.version == 0
+    assert store.cross.matrix == matrix
+    assert not changes
+
+
+def test_valid_rate_updates_row_and_column():
+    store = plugin.RateStore(lambda: RATES)
+    store["USD"] = 20.0
+    assert store.version == 1
+    assert store.cross.rate("USD", "MDL") == 20.0
+    assert store.cross.rate("MDL", "USD") == pytest.approx(1 / 20.0)
+    assert store.cross.rate("USD", "USD") == 1.0
+    assert store.cross.rate("USD", "RUB") == pytest.approx(20.0 * 5.5)
+
+
+@pytest.mark.parametrize("text", ["0", "-1", "nan", "inf", "-inf", "abc"])
+def test_parse_number_positive_rejects(text):
+    with pytest.raises(ValueError):
+        plugin.parse_number(text, positive=True)
+
+
+def test_parse_number():
+    assert plugin.parse_number("0") == 0.0
+    assert plugin.parse_number("18.65", positive=True) == 18.65
+    with pytest.raises(ValueError):
+        plugin.parse_number("nan")
+
+
+@pytest.mark.parametrize("value", [float("inf"), float("-inf"), float("nan"), "nan", "inf"])
+def test_fixed_point_rejects_non_finite(value):
+    with pytest.raises(ValueError):
+        plugin.to_minor(value)
+    with pytest.raises(ValueError):
+        plugin.to_fixed(value)
+
+
+def test_calculate_profits_rejects_non_finite():
+    mode = next(iter(plugin.game_registry.mode_factors))
+    with pytest.raises(ValueError):
+        plugin.calculate_profits((float("inf"),), (100.0,), ("uah",), (mode,), RATES)
+    with pytest.raises(ValueError):
+        plugin.calculate_profits((100.0,), (float("nan"),), ("uah",), (mode,), RATES)
+
+
+def test_exact_profit_at_half_kopeck_boundary():
+    # Точное значение 3428.98499937…: при масштабе 10**9 получалось 3428.99
+    rates = {"RUB": 5.5289, "UAH": 0.438, "BRL": 3.5, "USD": 18.65}
+    _, profits_rub, _ = plugin.calculate_profits((3850.75,), (40.44,), ("uah",), ("clash_items",), rates)
+    assert profits_rub == [3428.98]
@@ -0,0 +1,99 @@
+"""Общий файл курсов SharedRates: seqlock, владелец файла и подключение без записи."""
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rate_calculator_plugin as plugin
+
+RATES = {"RUB": 5.5, "UAH": 0.44, "BRL": 3.5, "USD": 18.6}
+
+
+def test_sharing_is_off_by_default():
+    assert plugin.SHARED_RATES_FILE is None
+    assert plugin.shared_rates is None
+
+
+def test_publish_and_snapshot(tmp_path):
+    shared = plugin.SharedRates(str(tmp_path / "rates.shm"))
+    assert shared.snapshot()[2] == {}
+    assert shared.publish({"USD": 19.0, "UAH": 0.45})
+    assert not shared.publish({"USD": 19.0})
+    sequence, _, rates = shared.snapshot()
+    assert rates == {"USD": 19.0, "UAH": 0.45}
+    assert sequence == 2 and not sequence & 1
+    reader = plugin.SharedRates(shared.path)
+    assert reader.sequence == sequence
+    assert os.stat(shared.path).st_mode & 0o777 == 0o600
+
+
+def test_attach_reads_without_publishing(tmp_path):
+    shared = plugin.SharedRates(str(tmp_path / "rates.shm"))
+    # Пустой общий файл: локальные курсы не публикуются
+    assert shared.attach(dict(RATES), saved_at=1.0) == RATES
+    sequence, _, rates = shared.snapshot()
+    assert (sequence, rates) == (0, {})
+    shared.publish({"USD": 20.0, "UAH": float("nan")})
+    # Общий файл новее: берутся только корректные курсы
+    assert shared.attach(dict(RATES), saved_at=0.0) == {**RATES, "USD": 20.0}
+    # Локальный файл новее: общие курсы не применяются и не перезаписываются
+    assert shared.attach(dict(RATES), saved_at=shared.snapshot()[1] + 1) == RATES
+    assert shared.snapshot()[2]["USD"] == 20.0
+
+
+def test_rejects_symlink(tmp_path):
+    target = tmp_path / "target.shm"
+    target.write_bytes(b"")
+    link = tmp_path / "rates.shm"
+    link.symlink_to(target)
+    with pytest.raises(OSError):
+        plugin.SharedRates(str(link)).snapshot()
+
+
+def test_rejects_file_of_another_user(tmp_path, monkeypatch):
+    path = tmp_path / "rates.shm"
+    path.write_bytes(b"")
+    monkeypatch.setattr(plugin.os, "getuid", lambda: os.stat(path).st_uid + 1)
+    with pytest.raises(PermissionError):
+        plugin.SharedRates(str(path)).snapshot()
+
+
+def test_recovers_from_writer_crash(tmp_path):
+    shared = plugin.SharedRates(str(tmp_path / "rates.shm"))
+    shared.publish({"USD": 19.0})
+    # Писатель упал между нечётным и чётным seq
+    view = shared._view()
+    shared.SEQUENCE.pack_into(view, shared.SEQUENCE_OFFSET, 3)
+    sequence, _, rates = shared.snapshot()
+    assert sequence == 4
+    assert rates == {"USD": 19.0}
+
+
+def _hammer(path: str, count: int):
+    shared = plugin.SharedRates(path)
+    for value in range(1, count + 1):
+        shared.publish({"USD": float(value), "UAH": float(value), "BRL": float(value)})
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="нужен fork")
+def test_readers_never_see_torn_writes(tmp_path):
+    path = str(tmp_path / "rates.shm")
+    shared = plugin.SharedRates(path)
+    shared.publish({"USD": 0.0, "UAH": 0.0, "BRL": 0.0})
+    context = multiprocessing.get_context("fork")
+    writers = [context.Process(target=_hammer, args=(path, 2000)) for _ in range(2)]
+    for writer in writers:
+        writer.start()
+    snapshots = 0
+    while any(writer.is_alive() for writer in writers) or not snapshots:
+        sequence, _, rates = shared.snapshot()
+        assert not sequence & 1
+        assert len(set(rates.values())) == 1, rates
+        snapshots += 1
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+    assert shared.snapshot()[2]["USD"] == 2000.0